@@ -1,6 +1,5 @@
 from mjdir.MultiJobDirectory import MultiJobDirectory
 import os
-import time
 
 #Example for basic usage
 jobdir = MultiJobDirectory("TestJobs")
@@ -44,8 +43,8 @@ def fun_test_success(path):
         return out
 
 
-print("Waiting 10s ...")
-time.sleep(10)
+print("Waiting for jobs ...")
+jobdir.wait(timeout=600)
     
 #Use get() or by evaluate(function)
 print(fun_test_success(jobdir.get()['job_1']['path']))
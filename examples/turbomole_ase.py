@@ -1,6 +1,5 @@
 import os
 import numpy as np
-import time
 from mjdir.MultiJobDirectory import MultiJobDirectory
 from mjdir.commands.turbomole import TURBOMOLE_SLURM_HEADERS,TURBOMOLE_SLURM_COMMANDS,write_turbomole_input,read_turbomole_output,read_turbomole_eiger_file
 
@@ -45,28 +44,18 @@ for i in range(0,len(jobs)):
 
 jd.save()
 
-print("submit ridft")
+print("submit ridft and readout")
 runnjobs = jd.run(procs=1,
                   asyn=2,
-                  command= TURBOMOLE_SLURM_COMMANDS["energy"],
+                  stages = {"energy": TURBOMOLE_SLURM_COMMANDS["energy"],
+                            "eiger": TURBOMOLE_SLURM_COMMANDS["eiger"]}, # eiger starts after ridft finished
                   header = TURBOMOLE_SLURM_HEADERS["int-nano"],
                   queue_properties = slurm_params,
                   submit_properties = {}, # for int-nano
                   prepare_only=False)
 
-print("Waiting 10s ...")
-time.sleep(10)
-
-print("submit readout")
-runnjobs = jd.run(procs=2,
-                  command= TURBOMOLE_SLURM_COMMANDS["eiger"],
-                  header = TURBOMOLE_SLURM_HEADERS["int-nano"],
-                  queue_properties = slurm_params,
-                  submit_properties = {}, # for int-nano
-                  prepare_only=False)
-
-print("Waiting 10s ...")
-time.sleep(10)
+print("Waiting for jobs ...")
+jd.wait(timeout=7200)
 
 # Check readout    
 homos = []
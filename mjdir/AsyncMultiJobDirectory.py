@@ -0,0 +1,303 @@
+import asyncio
+import contextlib
+import os
+import time
+import weakref
+
+from mjdir.MultiJobDirectory import MultiJobDirectory
+from mjdir.queue.slurm import make_slurm_sub_async, make_slurm_queue_async, make_slurm_cancel_async, \
+    read_slurm_states, batch_slurm_ids, submit_slurm_script_async, split_slurm_id
+from mjdir.storage import async_file_lock
+from mjdir.watch import DirectoryWatcher
+
+# Event loop to dict of main directory to asyncio.Lock of its backlog
+BACKLOG_LOCKS = weakref.WeakKeyDictionary()
+
+
+class AsyncMultiJobDirectory(MultiJobDirectory):
+    """MultiJobDirectory with asyncio coroutines for submission, queue polling and cancellation.
+
+    run(), submit_backlog(), drain_backlog(), queue(), cancel(), status(), wait() and as_completed() are
+    coroutines that call the queueing system via asyncio.create_subprocess_exec, so that they can be used within
+    an event loop without blocking it or switching to threads. All other methods are the same as for
+    MultiJobDirectory.
+    """
+
+    def __init__(self, name, dirpath=os.path.join(os.path.expanduser("~"), "MultiJobDirectory"), storage="json",
+                 shard_depth=None, compact=False, max_concurrency=16, retries=3, retry_delay=1.0):
+        """Creates a new or "loads" an existing directory and initializes class.
+
+        Args:
+            name (str): Name of the directory, see MultiJobDirectory.
+            dirpath (str): Path where to make/find the main jobdirectory, see MultiJobDirectory.
+            storage (str): Storage backend for the job information, see MultiJobDirectory.
+            shard_depth (int): Number of hash prefix levels for the job directories, see MultiJobDirectory.
+            compact (bool): Whether to keep the job information in a compact column store, see MultiJobDirectory.
+            max_concurrency (int): Maximum number of simultaneous calls to the queueing system. Default is 16.
+            retries (int): Number of retries of a submission on transient errors of the queueing system.
+                           Default is 3.
+            retry_delay (float): Delay before the first retry in seconds, doubled for each retry. Default is 1.
+        """
+        super(AsyncMultiJobDirectory, self).__init__(name, dirpath=dirpath, storage=storage,
+                                                     shard_depth=shard_depth, compact=compact)
+        self.max_concurrency = max_concurrency
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+    async def _gather_limited(self, coroutines):
+        """Run coroutines concurrently with at most max_concurrency at a time and return results in order."""
+        semaphore = asyncio.Semaphore(max(self.max_concurrency, 1))
+
+        async def limited(coroutine):
+            async with semaphore:
+                return await coroutine
+
+        return await asyncio.gather(*[limited(x) for x in coroutines])
+
+    def _get_backlog_lock(self):
+        """asyncio.Lock of the backlog of the main directory, shared by all instances in the running event loop."""
+        locks = BACKLOG_LOCKS.setdefault(asyncio.get_running_loop(), {})
+        if self.dirmain not in locks:
+            locks[self.dirmain] = asyncio.Lock()
+        return locks[self.dirmain]
+
+    @contextlib.asynccontextmanager
+    async def _edit_backlog_async(self):
+        """Async version of _edit_backlog(), which also excludes other coroutines of this process and does not
+        block the event loop while waiting for the file lock."""
+        async with self._get_backlog_lock(), \
+                async_file_lock(os.path.join(self.dirmain, self.backlog_name) + ".lock"):
+            backlog = self._read_backlog()
+            yield backlog
+            self._write_backlog(backlog)
+
+    async def _read_backlog_async(self):
+        """Read the submission backlog under the locks of _edit_backlog_async()."""
+        async with self._get_backlog_lock(), \
+                async_file_lock(os.path.join(self.dirmain, self.backlog_name) + ".lock", shared=True):
+            return self._read_backlog()
+
+    async def run(self, jobs=0, procs=1, asyn=0,
+                  header="",
+                  command="",
+                  command_arguments=['path'],
+                  queue_properties={},
+                  submit_properties={},
+                  prepare_only=False,
+                  array=False,
+                  array_limit=0,
+                  worker=False,
+                  pool=False,
+                  cost=None,
+                  telemetry=True,
+                  markers=True,
+                  manifest=False,
+                  max_in_flight=0,
+                  stages=None):
+        """Write scripts and submit them concurrently. Arguments are the same as for MultiJobDirectory.run().
+        The scripts of one stage are submitted concurrently, stages one after another.
+
+        Returns:
+            queue_ids (list): Ids of the submission calls in order of the scripts. Failed submissions are None.
+                              With stages a dict of stage name to the list of ids.
+        """
+        if stages is not None:
+            plan = self._plan_stages(stages, worker, max_in_flight)
+            stage_scripts = {}
+            for stage, stage_command, _ in plan:
+                stage_scripts[stage] = self._prepare_run(jobs, procs, asyn, header, stage_command, command_arguments,
+                                                         queue_properties, array, array_limit, worker, pool, cost,
+                                                         telemetry, markers, manifest, stage=stage)
+            if prepare_only:
+                return {}
+            stage_ids = {}
+            if self.submit_type == "SLURM":
+                for stage, _, parents in plan:
+                    submissions = []
+                    for i, bash_submit in enumerate(stage_scripts[stage]):
+                        properties = self._get_stage_properties(submit_properties, [stage_ids[x][i] for x in parents],
+                                                                array)
+                        submissions.append(self._submit_stage_script(bash_submit, properties))
+                    stage_ids[stage] = await self._gather_limited(submissions)
+            return stage_ids
+
+        scripts = self._prepare_run(jobs, procs, asyn, header, command, command_arguments, queue_properties,
+                                    array, array_limit, worker, pool, cost, telemetry, markers, manifest)
+        if prepare_only:
+            return []
+        if max_in_flight > 0:
+            async with self._edit_backlog_async() as backlog:
+                backlog["max_in_flight"] = max_in_flight
+                backlog["scripts"] += [{"script": x, "submit_properties": submit_properties} for x in scripts]
+            return await self.submit_backlog()
+        if self.submit_type == "SLURM":
+            return await self._gather_limited([
+                make_slurm_sub_async(self.dirmain, x, submit_properties, retries=self.retries,
+                                     retry_delay=self.retry_delay) for x in scripts])
+        return []
+
+    async def _submit_stage_script(self, bash_submit, properties):
+        if properties is None:
+            print("Error: Not submitting %s, since a previous stage failed." % bash_submit)
+            return None
+        return await make_slurm_sub_async(self.dirmain, bash_submit, properties, retries=self.retries,
+                                          retry_delay=self.retry_delay)
+
+    async def submit_backlog(self, max_in_flight=None):
+        """Submit scripts of the backlog, see MultiJobDirectory.submit_backlog(). Other coroutines of this process
+        wait for the submission to finish without blocking the event loop.
+
+        Returns:
+            queue_ids (list): Ids of the submitted scripts.
+        """
+        submitted = []
+        if self.submit_type != "SLURM":
+            return submitted
+        async with self._edit_backlog_async() as backlog:
+            if max_in_flight is not None:
+                backlog["max_in_flight"] = max_in_flight
+            if len(backlog["scripts"]) == 0:
+                return submitted
+            list_ids, _ = await self.queue(print_level=0, max_age=0)
+            in_flight = len(set(split_slurm_id(x)[0] for x in list_ids))
+            while len(backlog["scripts"]) > 0 and (backlog["max_in_flight"] <= 0 or
+                                                   in_flight < backlog["max_in_flight"]):
+                entry = backlog["scripts"][0]
+                id_sub, error = await submit_slurm_script_async(self.dirmain, entry["script"],
+                                                                entry["submit_properties"], retries=self.retries,
+                                                                retry_delay=self.retry_delay)
+                if not self._update_backlog(backlog, id_sub, error):
+                    break
+                if error is None:
+                    submitted.append(id_sub)
+                    in_flight += 1
+        return submitted
+
+    async def drain_backlog(self, max_in_flight=None, poll_interval=60.0, timeout=None):
+        """Submit the backlog as submissions leave the queue until it is empty, see
+        MultiJobDirectory.drain_backlog().
+
+        Returns:
+            queue_ids (list): Ids of the submitted scripts.
+        """
+        submitted = []
+        start = time.monotonic()
+        while True:
+            submitted += await self.submit_backlog(max_in_flight)
+            backlog = await self._read_backlog_async()
+            if len(backlog["scripts"]) == 0:
+                return submitted
+            if timeout is not None and time.monotonic() - start + poll_interval > timeout:
+                print("Warning: Backlog not empty after %s seconds." % timeout)
+                return submitted
+            await asyncio.sleep(poll_interval)
+
+    async def queue(self, print_level=2, max_age=None):
+        """Check queueing system, see MultiJobDirectory.queue().
+
+        Returns:
+            list_ids,list_scripts (tuple): list of ids, running scripts.
+        """
+        if self.submit_type == "SLURM":
+            return await make_slurm_queue_async(self.dirmain, print_level=print_level, max_age=max_age)
+        return [], []
+
+    async def cancel(self, ids=[], jobs=None, scripts=None, state=None, batch_size=1000):
+        """Cancel queue ids or a selection of jobs with concurrent batches, see MultiJobDirectory.cancel().
+
+        Args:
+            ids (str,list): queue ids to cancel. Can be single string, list of ids or int.
+                            None entries of failed submissions are ignored.
+            jobs (str,list,int): Cancel the scripts of these jobs. Same selection as in get(). Default is None.
+            scripts (str,list): Cancel these scripts by name like 'Name_3.sh'. Default is None.
+            state (str): Only cancel the scripts of jobs with this state of status(). Default is None.
+            batch_size (int): Maximum number of ids per call of the queueing system. Default is 1000.
+
+        Returns:
+            cancelled (list): Queue ids that were cancelled.
+        """
+        if isinstance(ids, (str, int)):
+            ids = [ids]
+        ids = [str(x) for x in ids if x is not None]
+        if self.submit_type == "SLURM":
+            if jobs is not None or scripts is not None or state is not None:
+                list_ids, list_scripts = await self.queue(print_level=0, max_age=0)
+                if state is not None:
+                    jobs = await self.status(0 if jobs is None else jobs, state=state)
+                ids += self._get_script_ids(jobs, scripts, list_ids, list_scripts)
+            results = await self._gather_limited([make_slurm_cancel_async(x)
+                                                  for x in batch_slurm_ids(ids, batch_size)])
+            return [x for batch in results for x in batch]
+        return []
+
+    async def status(self, jobs=0, state=None, use_queue=True):
+        """Get the state of jobs, see MultiJobDirectory.status()."""
+        sub_jobs = self.get(jobs)
+        scripts_in_queue = set()
+        if use_queue:
+            _, scripts_in_queue = await self.queue(print_level=0)
+            scripts_in_queue = set(scripts_in_queue)
+        backlog = await self._read_backlog_async()
+        return self._make_status(sub_jobs, scripts_in_queue, use_queue, state, backlog["scripts"])
+
+    async def as_completed(self, jobs=0, timeout=None, poll_interval=1.0, max_interval=60.0):
+        """Asynchronously iterate over jobs as they finish, see MultiJobDirectory.as_completed().
+
+        Yields:
+            tuple: Job name and state ('done' or 'failed').
+
+        Raises:
+            TimeoutError: If not all jobs finished within timeout.
+        """
+        scripts, pending = self._get_submitted_scripts(jobs)
+        offsets = {}
+        states = {}
+        scripts_in_queue = set()
+        seen_scripts = set()
+        last_queue = None
+        interval = poll_interval
+        start = time.monotonic()
+        loop = asyncio.get_running_loop()
+        changed = asyncio.Event()
+        with DirectoryWatcher(self.dirmain) as watcher:
+            if watcher.is_active:
+                loop.add_reader(watcher.fileno(), changed.set)
+            try:
+                while len(pending) > 0:
+                    if last_queue is None or time.monotonic() - last_queue >= poll_interval:
+                        _, scripts_in_queue = await self.queue(print_level=0)
+                        scripts_in_queue = set(scripts_in_queue)
+                        seen_scripts.update(scripts_in_queue)
+                        last_queue = time.monotonic()
+                    read_slurm_states(self.dirmain, offsets=offsets, states=states)
+                    finished, pending = self._split_completed(pending, scripts, states, scripts_in_queue,
+                                                              seen_scripts)
+                    for x in finished:
+                        yield x
+                    interval = poll_interval if len(finished) > 0 else min(2 * interval, max_interval)
+                    if len(pending) > 0:
+                        wait_time = self._get_wait_time(interval, timeout, start, len(pending))
+                        try:
+                            await asyncio.wait_for(changed.wait(), wait_time)
+                        except asyncio.TimeoutError:
+                            pass
+                        changed.clear()
+                        watcher.drain()
+            finally:
+                if watcher.is_active:
+                    loop.remove_reader(watcher.fileno())
+
+    async def wait(self, jobs=0, timeout=None, poll_interval=1.0, max_interval=60.0):
+        """Wait until jobs finished without blocking the event loop, see MultiJobDirectory.wait().
+
+        Returns:
+            status (dict): Job name to state of finished jobs. Jobs missing did not finish within timeout.
+        """
+        finished = {}
+        try:
+            async for key, job_state in self.as_completed(jobs, timeout=timeout, poll_interval=poll_interval,
+                                                          max_interval=max_interval):
+                finished[key] = job_state
+        except TimeoutError as e:
+            print("Warning:", e)
+        return finished
@@ -1,10 +1,37 @@
 # import datetime
+import contextlib
+import fnmatch
+import functools
+import hashlib
+import heapq
+import itertools
 import json
 import os
+import re
 import shutil
-import subprocess
+import pickle
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 
-from mjdir.queue.slurm import make_slurm_queue, make_slurm_script, make_slurm_sub
+from mjdir.cache import ResultCache
+from mjdir.jobtable import JobTable
+from mjdir.results import ResultsTable
+from mjdir.storage import STORAGE_BACKENDS, JsonStorage, file_lock
+from mjdir.watch import DirectoryWatcher
+from mjdir.queue.slurm import make_slurm_queue, make_slurm_script, make_slurm_sub, make_slurm_array_script, \
+    split_slurm_id, make_task_queue, make_slurm_cancel, make_slurm_worker_script, read_slurm_telemetry, \
+    read_slurm_states, make_slurm_accounting, submit_slurm_script, is_slurm_limit_error
+
+
+def _parse_job_chunk(parser, chunk):
+    """Apply parser to the paths of a chunk of (name, path) and return (name, result, error) per job."""
+    out = []
+    for name, path in chunk:
+        try:
+            out.append((name, parser(path), None))
+        except Exception as e:
+            out.append((name, None, "%s: %s" % (type(e).__name__, e)))
+    return out
 
 
 class MultiJobDirectory(object):
@@ -14,13 +41,26 @@ class MultiJobDirectory(object):
     The function run() submits a script that goes to a job directory and execute a given command.
     """
 
-    def __init__(self, name, dirpath=os.path.join(os.path.expanduser("~"), "MultiJobDirectory")):
+    def __init__(self, name, dirpath=os.path.join(os.path.expanduser("~"), "MultiJobDirectory"), storage="json",
+                 shard_depth=None, compact=False):
         """Creates a new or "loads" an existing directory and initializes class.
         
         Args:
             name (str): Name of the directory 
             dirpath (str) : Path where to make/find the main jobdirectory on the operating system
                             Default is user path/MultiJobDirectory
+            storage (str): Storage backend for the job information. Either 'json' for a single JOBDIR_Info.json
+                           or 'sqlite' for an indexed database JOBDIR_Info.sqlite, which only reads and writes
+                           the jobs that are accessed or changed. An existing JOBDIR_Info.json is imported into
+                           a new database. Default is 'json'.
+            shard_depth (int): Number of hash prefix levels for the job directories, e.g. with 2 a job is placed
+                               in dirmain/ab/cd/<job>. This keeps the number of entries per directory small for
+                               very large job counts. The layout is stored in JOBDIR_Config.json.
+                               Use migrate_layout() to change the layout of an existing directory.
+                               Default is None, which is the stored layout or 0 for a flat directory.
+            compact (bool): Whether to keep the job information of the json storage in a compact column store,
+                            where equal strings are shared and paths are derived from the job name.
+                            Jobs are then returned as dict-like views instead of dicts. Default is False.
         """
 
         self.submit_type = "SLURM"  # Only possible queue system supported
@@ -28,15 +68,46 @@ class MultiJobDirectory(object):
         # File Management
         self.maindirpath = dirpath
         if not os.path.exists(self.maindirpath):
-            os.mkdir(self.maindirpath)
+            os.makedirs(self.maindirpath, exist_ok=True)
         self.dirname = name
         self.dirmain = os.path.join(dirpath, name)
         if not os.path.exists(self.dirmain):
-            os.mkdir(self.dirmain)
+            os.makedirs(self.dirmain, exist_ok=True)
+
+        # Layout
+        self.config_name = "JOBDIR_Config.json"
+        self.scan_name = "JOBDIR_Scan.json"
+        self._scan_snapshot = None
+        self.config = {"shard_depth": 0}
+        config = self._read_json_from_file(os.path.join(self.dirmain, self.config_name))
+        if config is not None:
+            self.config.update(config)
+        if shard_depth is not None and shard_depth != self.config["shard_depth"]:
+            if config is not None:
+                raise ValueError("Directory has shard depth %i, use migrate_layout() to change it." %
+                                 self.config["shard_depth"])
+            self.config["shard_depth"] = shard_depth
+            self._write_json_to_file(self.config, os.path.join(self.dirmain, self.config_name))
 
         # Main Dict
         self.jobinfo_name = "JOBDIR_Info.json"
-        self.jobinfo = {}
+        self.taskqueue_ending = ".tasks"
+        self.backlog_name = "JOBDIR_Backlog.json"
+        self.results_cache_name = "JOBDIR_Results.sqlite"
+        self.result_cache = ResultCache(os.path.join(self.dirmain, self.results_cache_name))
+        self.results_table_name = "JOBDIR_Results"
+        self.results = ResultsTable(os.path.join(self.dirmain, self.results_table_name))
+        self._bulk_add_threshold = 64
+        self._bulk_add_ratio = 16
+        self.compact = compact
+        self.jobinfo = self._make_jobinfo({})
+        self.storage = STORAGE_BACKENDS[storage](self.dirmain)
+        json_storage = JsonStorage(self.dirmain, self.jobinfo_name)
+        if storage != "json" and not self.storage.exists() and json_storage.exists():
+            with file_lock(json_storage.lockpath):
+                if not self.storage.exists():
+                    print("Info: Importing", self.jobinfo_name, "to", storage, "storage.")
+                    self.storage.save(json_storage._read())
         self.load()
 
     ###########################################################################
@@ -53,7 +124,7 @@ class MultiJobDirectory(object):
             filename (str): Filename or -path to write dictionary to
         """
         with open(filename, 'w') as json_file:
-            json.dump(out_dict, json_file)
+            json.dump(out_dict, json_file, default=dict)
 
     @staticmethod
     def _read_json_from_file(filename):
@@ -153,14 +224,100 @@ class MultiJobDirectory(object):
                 max_num = max(int(x[-1]), max_num)
         return max_num + 1
 
-    def _clean_jobname(self, name):
+    @staticmethod
+    def _get_job_costs(sub_jobs, cost):
+        """Cost estimate per job from a jobinfo key, a dict or a callable. Missing costs are set to the mean."""
+        costs = []
+        for key, value in sub_jobs.items():
+            if callable(cost):
+                costs.append(cost(key, value))
+            elif isinstance(cost, dict):
+                costs.append(cost.get(key))
+            else:
+                costs.append(value.get(cost))
+        known = [float(x) for x in costs if x is not None]
+        default = sum(known) / len(known) if len(known) > 0 else 1.0
+        return [float(x) if x is not None else default for x in costs]
+
+    @staticmethod
+    def _balance_jobs(costs, num_bins):
+        """Distribute job indices on bins by longest-processing-time-first. Jobs in bins are sorted by cost."""
+        bins = [[] for _ in range(num_bins)]
+        loads = [(0.0, i) for i in range(num_bins)]
+        for j in sorted(range(len(costs)), key=lambda x: costs[x], reverse=True):
+            load, i = heapq.heappop(loads)
+            bins[i].append(j)
+            heapq.heappush(loads, (load + costs[j], i))
+        return [x for x in bins if len(x) > 0]
+
+    def _set_job_script(self, jobs, script, stage=None):
+        """Store the name of the bash script that runs the jobs in jobinfo, per stage in 'stage_scripts'."""
+        for x in jobs:
+            self.jobinfo[x]['script'] = script
+            if stage is not None:
+                stage_scripts = dict(self.jobinfo[x].get('stage_scripts', {}))
+                stage_scripts[stage] = script
+                self.jobinfo[x]['stage_scripts'] = stage_scripts
+
+    def _get_job_path(self, name):
+        """path of the job directory for the (sharded) layout"""
+        depth = self.config["shard_depth"]
+        if depth <= 0:
+            return os.path.join(self.dirmain, name)
+        name_hash = hashlib.md5(name.encode("utf8")).hexdigest()
+        return os.path.join(self.dirmain, *[name_hash[2 * i:2 * i + 2] for i in range(depth)], name)
+
+    def _get_job_directory_list(self):
+        """lists all job directories found in the (sharded) layout"""
+        searchpaths = [self.dirmain]
+        for _ in range(self.config["shard_depth"]):
+            searchpaths = [f.path for x in searchpaths for f in os.scandir(x) if f.is_dir() and len(f.name) == 2 and
+                           all(c in "0123456789abcdef" for c in f.name)]
+        dirlist = []
+        for x in searchpaths:
+            dirlist += [y for y in self._get_directory_list(x) if self._is_job_directory(y)]
+        return dirlist
+
+    def _find_existing_jobs(self, add_paths):
+        """whether the directory of each job exists. Per shard leaf, the leaf is listed once instead of checking
+        each job if there are at least _bulk_add_threshold jobs in it and listing is cheaper than the checks,
+        i.e. the leaf has less than _bulk_add_ratio entries per job. Jobs of missing leafs do not exist."""
+        leafs = {}
+        for name, path in add_paths.items():
+            leafs.setdefault(os.path.dirname(path), []).append(name)
+        is_folder = {}
+        for leaf, names in leafs.items():
+            try:
+                num_links = os.stat(leaf).st_nlink
+            except OSError:
+                is_folder.update({x: False for x in names})
+                continue
+            # Number of subdirectories from the link count, which is not available on all filesystems (< 2).
+            is_cheap = num_links < 2 or len(names) * self._bulk_add_ratio >= num_links - 2
+            if len(names) >= self._bulk_add_threshold and is_cheap:
+                existing = set(self._get_directory_list(leaf))
+                is_folder.update({x: x in existing for x in names})
+            else:
+                is_folder.update({x: os.path.exists(add_paths[x]) for x in names})
+        return is_folder
+
+    def _is_job_directory(self, name):
+        """whether a directory name in the main or a shard directory can be a job, i.e. is not a task queue or
+        reserved JOBDIR_* entry like the results table or the staging directory of migrate_layout()"""
+        return not name.endswith(self.taskqueue_ending) and not name.startswith("JOBDIR_")
+
+    def _make_jobinfo(self, jobinfo):
+        """convert job information to compact job table if requested"""
+        if self.compact and isinstance(jobinfo, dict):
+            return JobTable.from_dict(jobinfo, path_function=self._get_job_path)
+        return jobinfo
+
+    def _clean_jobname(self, name, verbose=True):
         """ clean the jobname from unwanted chars"""
         bad_chars = r"[-()\"#/@;:<>{}`+=~|.!?,]"
         former = int(len(name))
-        for x in bad_chars:
-            name = name.replace(x, "")
-        name = name.replace(" ", "")
-        if int(len(name)) != former:
+        name = name.translate(str.maketrans("", "", bad_chars + " "))
+        if int(len(name)) != former and verbose:
             print("Warning: Invalid dir name, replaced by", name)
         return name
 
@@ -168,84 +325,255 @@ class MultiJobDirectory(object):
     # Public
     ###########################################################################
 
-    def save(self):
-        self._write_json_to_file(self.jobinfo, os.path.join(self.dirmain, self.jobinfo_name))
+    def save(self, jobs=None):
+        """
+        Save job information. Changes of other processes on the same directory since the last load() or save()
+        are merged, so that multiple processes can add and modify jobs at the same time.
+
+        Args:
+            jobs (str,list): Only save these jobs without rewriting the full job information. Default is None.
+        """
+        if isinstance(jobs, str):
+            jobs = [jobs]
+        merged = self.storage.save(self.jobinfo, jobs=jobs)
+        if merged is not None:
+            self.jobinfo = merged
+        if jobs is None and self._scan_snapshot is not None:
+            # Own files in the main directory change its mtime but not its number of subdirectories. Only for
+            # sharded layouts, since in the flat layout the same number of subdirectories may be different jobs.
+            scan_dirs = self._scan_snapshot["dirs"]
+            if "" in scan_dirs and self.config["shard_depth"] > 0:
+                dirstat = os.stat(self.dirmain)
+                if dirstat.st_nlink == scan_dirs[""][1]:
+                    scan_dirs[""] = [dirstat.st_mtime_ns, dirstat.st_nlink]
+            self._write_json_to_file(self._scan_snapshot, os.path.join(self.dirmain, self.scan_name))
+            self._scan_snapshot = None
 
     def load(self, add_existing=False):
-        if os.path.exists(os.path.join(self.dirmain, self.jobinfo_name)):
-            self.jobinfo = self._read_json_from_file(os.path.join(self.dirmain, self.jobinfo_name))
-        for key, value in self.jobinfo.items():
-            if os.path.abspath(os.path.dirname(value['path'])) != self.dirmain:
-                print("Error: Loaded of data has wrong path.", key)
-        alljobs = list(self.jobinfo.keys())
-        alljobs_dir = self._get_directory_list(self.dirmain)
+        if self.storage.lazy:
+            self.jobinfo = self.storage.load()
+        elif self.storage.exists():
+            # Jobs are read one at a time into the (compact) table without a dict of all jobs
+            self.jobinfo = self.storage.load(self._make_jobinfo({}))
+        if not self.storage.lazy:
+            prefix = os.path.join(self.dirmain, "")
+            for key, value in self.jobinfo.items():
+                if not value['path'].startswith(prefix):
+                    print("Error: Loaded of data has wrong path.", key)
         if add_existing:
-            found_dirs = False
-            for x in alljobs_dir:
-                if x not in alljobs:
-                    self.add(x)
-                    found_dirs = True
-            if found_dirs:
-                print("Warning: Additional directories found. Adding directories...")
+            self.reconcile()
+
+    def reconcile(self, force=False, remove_orphans=False):
+        """
+        Reconcile job directories on disk with the job information.
+
+        The modification time and number of subdirectories of each scanned directory are stored in
+        JOBDIR_Scan.json by the next save(), so that only directories that changed since the last saved reconcile()
+        are listed again. New directories are added to the job information in one batch.
+        This mainly helps sharded layouts: In the flat layout (shard_depth=0) all jobs are in the main directory,
+        whose modification time also changes with every script and state file written there, so that it is
+        listed again on almost every call.
+
+        Args:
+            force (bool): Whether to list all directories regardless of the last scan. Default is False.
+            remove_orphans (bool): Whether to remove job entries whose directory vanished. Default is False.
+
+        Returns:
+            dict: Lists of 'added' and 'orphaned' job names.
+        """
+        scanpath = os.path.join(self.dirmain, self.scan_name)
+        snapshot = self._scan_snapshot
+        if snapshot is None:
+            snapshot = self._read_json_from_file(scanpath)
+        if force or snapshot is None or snapshot.get("shard_depth") != self.config["shard_depth"]:
+            snapshot = {"shard_depth": self.config["shard_depth"], "dirs": {}}
+        old_dirs = snapshot["dirs"]
+        new_dirs = {}
+        children = {}
+        for x in old_dirs:
+            if x != "":
+                children.setdefault(os.path.dirname(x), []).append(x)
+
+        # Single pass over shard levels, only list directories that changed
+        current = [""]
+        changed_leafs = {}
+        for level in range(self.config["shard_depth"] + 1):
+            next_level = []
+            for x in current:
+                dirpath = os.path.join(self.dirmain, x)
+                try:
+                    dirstat = os.stat(dirpath)
+                except FileNotFoundError:
+                    continue
+                new_dirs[x] = [dirstat.st_mtime_ns, dirstat.st_nlink]
+                old = old_dirs.get(x)
+                is_changed = old is None or dirstat.st_mtime_ns != old[0] or dirstat.st_nlink != old[1]
+                if level < self.config["shard_depth"]:
+                    if is_changed:
+                        next_level += [os.path.join(x, f.name) for f in os.scandir(dirpath) if f.is_dir() and
+                                       len(f.name) == 2 and all(c in "0123456789abcdef" for c in f.name)]
+                    else:
+                        next_level += children.get(x, [])
+                elif is_changed:
+                    changed_leafs[x] = [f.name for f in os.scandir(dirpath) if
+                                        f.is_dir() and self._is_job_directory(f.name)]
+            current = next_level
+
+        # Compare with job information of changed directories
+        added = []
+        orphaned = []
+        if len(changed_leafs) > 0:
+            expected = {}
+            for x in self.jobinfo:
+                leaf = os.path.relpath(os.path.dirname(self._get_job_path(x)), self.dirmain)
+                leaf = "" if leaf == "." else leaf
+                if leaf in changed_leafs or leaf not in new_dirs:
+                    expected.setdefault(leaf, set()).add(x)
+            for leaf, names in changed_leafs.items():
+                found = set(names)
+                added += [x for x in names if x not in self.jobinfo]
+                orphaned += [x for x in expected.pop(leaf, set()) if x not in found]
+            for leaf, names in expected.items():
+                if leaf not in new_dirs:
+                    orphaned += list(names)
+        for x in added:
+            self.jobinfo[x] = {"path": str(self._get_job_path(x))}
+        if len(added) > 0:
+            print("Warning: Additional directories found. Added %i directories." % len(added))
+        if len(orphaned) > 0:
+            print("Warning: Found %i jobs without directory." % len(orphaned))
+            if remove_orphans:
+                for x in orphaned:
+                    self.jobinfo.pop(x)
+        snapshot["dirs"] = new_dirs
+        self._scan_snapshot = snapshot
+        return {"added": added, "orphaned": orphaned}
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Context manager to group changes like bulk add() into a single save() at the end.
+
+        Example:
+            with maindir.transaction():
+                for x in names:
+                    maindir.add(x)
+        """
+        yield self
+        self.save()
 
-    def add(self, job):
+    def export_json(self, filepath=None):
+        """
+        Export the job information to a json file, independent of the storage backend.
+
+        Args:
+            filepath (str): Filepath of the json file. Default is None, JOBDIR_Info.json in the main directory.
+        """
+        if filepath is None:
+            filepath = os.path.join(self.dirmain, self.jobinfo_name)
+        self._write_json_to_file(dict(self.jobinfo.items()), filepath)
+
+    def add(self, job, workers=8):
         """
         Main function to add job plus e.g. command. Command is updated if job already exists.
         Adding a job means creating a file directory. Commands are stored in dictionaries.
+
+        For many jobs, names are deduplicated in memory, existing directories are found by a single directory
+        listing and missing directories are created by a thread pool.
         
         Args:
             job (str,list,dict): Job names to be created. Either single string or list of strings
+            workers (int): Number of threads to create directories. Default is 8.
             
         Return:
             pathlist (dict): Path to the created file directories (string or list)
         """
-        pathlist = {}
         if isinstance(job, str):
-            job = self._clean_jobname(job)
-            jobpath = os.path.join(self.dirmain, job)
-            is_folder = os.path.exists(jobpath)
-            is_jobentry = job in self.jobinfo
-            if not is_folder:
-                os.mkdir(jobpath)
-            if is_jobentry:
-                self.jobinfo[job].update({"path": str(jobpath)})  # ,  "modified" : str(datetime.datetime.now())
-            else:
-                self.jobinfo[job] = {"path": str(jobpath)}  # , "created" : str(datetime.datetime.now())
-            pathlist.update({job: self.jobinfo[job]})
-        if isinstance(job, list):
-            for i in range(0, len(job)):
-                i_job = self._clean_jobname(job[i])
-                jobpath = os.path.join(self.dirmain, i_job)
-                is_folder = os.path.exists(jobpath)
-                is_jobentry = i_job in self.jobinfo
-                if not is_folder:
-                    os.mkdir(jobpath)
-                if is_jobentry and is_folder:
-                    self.jobinfo[i_job].update({"path": str(jobpath)})
+            name = self._clean_jobname(job)
+            add_jobs = {name: {}}
+        elif isinstance(job, (list, dict)):
+            add_jobs = {}
+            num_renamed = 0
+            for x in job:
+                name = self._clean_jobname(x, verbose=False)
+                if name != x:
+                    num_renamed += 1
+                if isinstance(job, dict):
+                    add_jobs.setdefault(name, {}).update(job[x])
                 else:
-                    self.jobinfo[i_job] = {"path": str(jobpath)}
-                pathlist.update({i_job: self.jobinfo[i_job]})
-        if isinstance(job, dict):
-            for key, value in job.items():
-                i_job = self._clean_jobname(key)
-                jobpath = os.path.join(self.dirmain, i_job)
-                is_folder = os.path.exists(jobpath)
-                is_jobentry = i_job in self.jobinfo
-                if not is_folder:
-                    os.mkdir(jobpath)
-                jobaddinfo = {}
-                jobaddinfo.update(value)
-                if is_jobentry and is_folder:
-                    jobaddinfo.update({"path": str(jobpath)})
-                    self.jobinfo[i_job].update(jobaddinfo)
-                else:
-                    jobaddinfo.update({"path": str(jobpath)})
-                    self.jobinfo[i_job] = jobaddinfo
-                pathlist.update({i_job: self.jobinfo[i_job]})
+                    add_jobs[name] = {}
+            if num_renamed > 0:
+                print("Warning: Invalid dir names, replaced %i names." % num_renamed)
+        else:
+            return {}
+
+        # Existing directories
+        add_paths = {x: self._get_job_path(x) for x in add_jobs}
+        is_folder = self._find_existing_jobs(add_paths)
+
+        # Make missing directories
+        missing = [add_paths[x] for x in add_jobs if not is_folder[x]]
+        if len(missing) > 1 and workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(functools.partial(os.makedirs, exist_ok=True), missing))
+        else:
+            for x in missing:
+                os.makedirs(x, exist_ok=True)
+
+        # Update job information. An entry of a list or dict is renewed if its directory was missing.
+        pathlist = {}
+        for name, value in add_jobs.items():
+            jobaddinfo = {}
+            jobaddinfo.update(value)
+            jobaddinfo.update({"path": str(add_paths[name])})
+            if name in self.jobinfo and (is_folder[name] or isinstance(job, str)):
+                self.jobinfo[name].update(jobaddinfo)
+            else:
+                self.jobinfo[name] = jobaddinfo
+            pathlist[name] = self.jobinfo[name]
 
         return pathlist
 
-    def get(self, jobs=0, add_existing=False):
+    def _select_jobs(self, jobs):
+        """list of job names for a selection, membership is checked on the jobinfo dict"""
+        if isinstance(jobs, int):
+            jobs = slice(jobs, None)
+        if isinstance(jobs, slice):
+            start, stop, step = jobs.start, jobs.stop, jobs.step
+            if any(x is not None and x < 0 for x in [start, stop, step]):
+                start, stop, step = jobs.indices(len(self.jobinfo))
+            return list(itertools.islice(self.jobinfo, start, stop, step))
+        if isinstance(jobs, str):
+            if jobs in self.jobinfo:
+                return [jobs]
+            if any(x in jobs for x in "*?["):
+                return fnmatch.filter(self.jobinfo, jobs)
+            print("Warning: job not found.")
+            return []
+        if isinstance(jobs, type(re.compile(""))):
+            return [x for x in self.jobinfo if jobs.search(x)]
+        if callable(jobs):
+            return [key for key, value in self.jobinfo.items() if jobs(key, value)]
+        if isinstance(jobs, (list, tuple, set, dict)):
+            joblist = [x for x in jobs if x in self.jobinfo]
+            if len(joblist) < len(jobs):
+                print("Warning: Not all jobs exist, missing", len(jobs) - len(joblist))
+            return joblist
+        return []
+
+    def _filter_jobs(self, joblist, where):
+        """filter job names by jobinfo fields, uses the index of the storage for plain state or tag"""
+        for key, value in where.items():
+            if key in ["state", "tag"] and not callable(value) and hasattr(self.jobinfo, "select"):
+                indexed = set(self.jobinfo.select(**{key: value}))
+                joblist = [x for x in joblist if x in indexed]
+            elif callable(value):
+                joblist = [x for x in joblist if value(self.jobinfo[x].get(key))]
+            else:
+                joblist = [x for x in joblist if self.jobinfo[x].get(key) == value]
+        return joblist
+
+    def get(self, jobs=0, add_existing=False, where=None):
         """
         Get jobdict from job or list of jobs, which is used to write input.
         
@@ -254,38 +582,70 @@ class MultiJobDirectory(object):
                                  If (int) the index of all available jobs is taken: joblist[jobs:]
                                  jobs = 0 means all jobs
                                  jobs = -1 means last job in directory list (sorted by name?)
+                                 Further selections are a slice of all jobs, a glob pattern like 'mol_1*',
+                                 a compiled regular expression re.compile(...), a dict of jobs or
+                                 a function f(name, jobinfo) that returns True for selected jobs.
             add_existing (bool): Whether to add existing directories found. 
+            where (dict): Filter selected jobs by jobinfo fields, e.g. {'tag': 'opt'}. A value can also be
+                          a function f(value) that returns True for selected jobs. Default is None.
         
         Returns:
             outlist (dict): Filepath of existing job/joblist requested in jobs input
         """
-        alljobs = list(self.jobinfo.keys())
         if add_existing:
-            alljobs_dir = self._get_directory_list(self.dirmain)
-            found_dirs = False
-            for x in alljobs_dir:
-                if x not in alljobs:
-                    self.add(x)
-                    found_dirs = True
-            if found_dirs:
-                print("Warning: Additional directories found. Adding directories...")
-            alljobs = list(self.jobinfo.keys())
-        joblist = {}
-        if isinstance(jobs, int):
-            return {x: self.jobinfo[x] for x in alljobs[jobs:]}
-        if isinstance(jobs, str):
-            if jobs in alljobs:
-                return {jobs: self.jobinfo[jobs]}
-            else:
-                print("Warning: job not found.")
-        if isinstance(jobs, dict):
-            jobs = list(jobs.keys())
-        if isinstance(jobs, list):
-            joblist = {x: self.jobinfo[x] for x in jobs if x in alljobs}
-            if len(joblist) < len(jobs):
-                print("Warning: Not all jobs exist, missing", len(joblist) - len(jobs))
+            self.reconcile()
+        joblist = self._select_jobs(jobs)
+        if where is not None:
+            joblist = self._filter_jobs(joblist, where)
+        return {x: self.jobinfo[x] for x in joblist}
 
-        return joblist
+    def migrate_layout(self, shard_depth=0):
+        """
+        Move all job directories to a new (sharded) layout and update the job information.
+        The job information is saved afterwards. Do not use while jobs are running.
+
+        Args:
+            shard_depth (int): Number of hash prefix levels, 0 means flat layout. Default is 0.
+
+        Returns:
+            moved (list): Names of moved jobs.
+        """
+        old_paths = {x: self._get_job_path(x) for x in self._get_job_directory_list()}
+        old_paths.update({key: value['path'] for key, value in self.jobinfo.items()})
+        old_paths = {key: os.path.abspath(value) for key, value in old_paths.items()}
+        # Move jobs to a staging directory first, since job names may collide with shard directories
+        staging = os.path.join(self.dirmain, "JOBDIR_Migrate.tmp")
+        os.makedirs(staging, exist_ok=True)
+        staged = []
+        for key, old_path in old_paths.items():
+            if os.path.exists(old_path):
+                os.rename(old_path, os.path.join(staging, key))
+                staged.append(key)
+        # Remove empty shard directories of the old layout
+        old_shards = set()
+        for key, old_path in old_paths.items():
+            shard = os.path.dirname(old_path)
+            while shard != self.dirmain and shard.startswith(self.dirmain):
+                old_shards.add(shard)
+                shard = os.path.dirname(shard)
+        for x in sorted(old_shards, key=len, reverse=True):
+            if os.path.exists(x) and len(os.listdir(x)) == 0:
+                os.rmdir(x)
+        self.config["shard_depth"] = shard_depth
+        self._write_json_to_file(self.config, os.path.join(self.dirmain, self.config_name))
+        moved = []
+        for key in staged:
+            new_path = self._get_job_path(key)
+            os.makedirs(os.path.dirname(new_path), exist_ok=True)
+            os.rename(os.path.join(staging, key), new_path)
+            if new_path != old_paths[key]:
+                moved.append(key)
+        for key in old_paths:
+            if key in self.jobinfo:
+                self.jobinfo[key]['path'] = str(self._get_job_path(key))
+        os.rmdir(staging)
+        self.save()
+        return moved
 
     def remove(self, jobs=0):
         """
@@ -296,11 +656,12 @@ class MultiJobDirectory(object):
                                  If (int) the index of all available jobs is taken: joblist[jobs:]
                                  jobs = 0 means all jobs
                                  jobs = -1 means last job in directory list (sorted by name?)
+                                 All selections of get() are possible.
                                  
         Returns:
             None
         """
-        jobs_to_remove = list(self.get(jobs).keys())
+        jobs_to_remove = self._select_jobs(jobs)
 
         for x in jobs_to_remove:
             self.jobinfo.pop(x)
@@ -311,7 +672,17 @@ class MultiJobDirectory(object):
             command_arguments=['path'],
             queue_properties={},
             submit_properties={},
-            prepare_only=False):
+            prepare_only=False,
+            array=False,
+            array_limit=0,
+            worker=False,
+            pool=False,
+            cost=None,
+            telemetry=True,
+            markers=True,
+            manifest=False,
+            max_in_flight=0,
+            stages=None):
         """Main function to start e.g. slurm arrays from jobs. The command is taken from the command 
         dictionary if not None and has preference over the command given in function call.
         
@@ -320,6 +691,7 @@ class MultiJobDirectory(object):
                                  If (int) the index of all available jobs is taken: joblist[jobs:]
                                  jobs = 0 means all jobs
                                  jobs = -1 means last job in directory list (sorted by name?)
+                                 All selections of get() are possible.
             procs (int): Number of bash scripts to start.            
             asyn (int): Number of asynchronous commands to start.
             header (str): Header for queueing system that is written to bash script.
@@ -331,14 +703,139 @@ class MultiJobDirectory(object):
             submit_properties (dict): Queue specific parameters for submission. Default is {}.
                                         Like {'-p',"partition"}
             prepare_only (bool): Whether to only make scripts etc. but not acutally run them.
+            array (bool): Whether to submit a single job array with procs tasks instead of procs scripts.
+                          Default is False.
+            array_limit (int): Maximum number of simultaneously running array tasks. Default is 0, no limit.
+            worker (bool): Whether to dispatch jobs dynamically. All jobs are written to a task queue in the
+                           main directory and procs worker scripts (or array tasks) claim the next job until the
+                           queue is drained. With asyn > 0 each script runs asyn workers. Default is False.
+            pool (bool): Whether to keep asyn commands running at all times in each script (rolling pool) instead
+                         of waiting for each block of asyn commands to finish. Exit codes of the jobs are recorded
+                         to <script>.exitcodes in the main directory. Default is False.
+            cost (str,dict,callable): Cost estimate per job to balance the jobs on the procs scripts by
+                                      longest-processing-time-first. Either a key of the jobinfo entries like
+                                      'runtime', a dict of job names to cost or a function f(name, jobinfo).
+                                      Jobs within a script (and the task queue) are started longest first.
+                                      Missing costs are set to the mean. Default is None, jobs are split in order.
+            telemetry (bool,str): Whether the scripts record start, end, exit status and node of each job
+                                  to <script>.jsonl in the main directory. See runtimes(). With 'maxrss' the
+                                  max RSS is also recorded via /usr/bin/time, which runs the commands with
+                                  bash -c, so that only exported variables and functions of the header are
+                                  available. Default is True.
+            markers (bool): Whether the scripts record the state of each job to <script>.state in the main
+                            directory. See status(). Default is True.
+            manifest (bool): Whether to write the formatted commands to <script>.manifest in the main directory
+                             in a single write and submit a small script that loops over its part of the manifest.
+                             Recommended for many jobs per script. Not used for worker. Default is False.
+            max_in_flight (int): Maximum number of submissions of this directory in the queue, e.g. to respect
+                                 a MaxSubmitJobs limit. Scripts beyond the limit are kept in a backlog in the main
+                                 directory and submitted by submit_backlog() or drain_backlog() as others leave
+                                 the queue. Default is 0, submit all scripts immediately.
+            stages (dict): Stages of a pipeline that are all submitted at once instead of a single command, like
+                           {'optimize': cmd1, 'energy': cmd2, 'eiger': cmd3}. Each stage uses the same split of the
+                           jobs and depends on the previous stage via --dependency=afterok, for job arrays via
+                           aftercorr, so that a script (or array task) starts as soon as the same script (or task)
+                           of the previous stage finished successfully, i.e. none of its jobs failed. A stage can
+                           also be given as {'command': cmd, 'after': [stage names]} to declare a DAG of stages.
+                           Commands per job are taken from a 'stages' dict of the job in jobinfo. Scripts that
+                           depend on a failed stage are removed from the queue. Not possible with worker or
+                           max_in_flight.
+                           Default is None.
         
         Returns:
-            queue_ids (list): The ruturn e.g. ids of the submission call
+            queue_ids (list): The ruturn e.g. ids of the submission call. Failed submissions are None.
+                              With stages a dict of stage name to the list of ids.
         """
+        if stages is not None:
+            plan = self._plan_stages(stages, worker, max_in_flight)
+            stage_scripts = {}
+            for stage, stage_command, _ in plan:
+                stage_scripts[stage] = self._prepare_run(jobs, procs, asyn, header, stage_command, command_arguments,
+                                                         queue_properties, array, array_limit, worker, pool, cost,
+                                                         telemetry, markers, manifest, stage=stage)
+            if prepare_only:
+                return {}
+            stage_ids = {}
+            if self.submit_type == "SLURM":
+                for stage, _, parents in plan:
+                    stage_ids[stage] = []
+                    for i, bash_submit in enumerate(stage_scripts[stage]):
+                        properties = self._get_stage_properties(submit_properties, [stage_ids[x][i] for x in parents],
+                                                                array)
+                        if properties is None:
+                            print("Error: Not submitting %s, since a previous stage failed." % bash_submit)
+                            stage_ids[stage].append(None)
+                            continue
+                        stage_ids[stage].append(make_slurm_sub(self.dirmain, bash_submit, properties))
+            return stage_ids
+
+        scripts = self._prepare_run(jobs, procs, asyn, header, command, command_arguments, queue_properties,
+                                    array, array_limit, worker, pool, cost, telemetry, markers, manifest)
+        if prepare_only:
+            return []
+        if max_in_flight > 0:
+            self._add_to_backlog(scripts, submit_properties, max_in_flight)
+            return self.submit_backlog()
+        id_list = []
+        if self.submit_type == "SLURM":
+            for bash_submit in scripts:
+                id_list.append(make_slurm_sub(self.dirmain, bash_submit, submit_properties))
+        return id_list
+
+    @staticmethod
+    def _plan_stages(stages, worker=False, max_in_flight=0):
+        """Order the stages of run() and return a list of (stage, command, parent stages)."""
+        if worker or max_in_flight > 0:
+            raise ValueError("Stages can not be used with worker or max_in_flight.")
+        names = list(stages.keys())
+        commands = {}
+        parents = {}
+        for i, name in enumerate(names):
+            value = stages[name]
+            after = [names[i - 1]] if i > 0 else []
+            if isinstance(value, dict):
+                after = value.get('after', after)
+                value = value.get('command', "")
+            if isinstance(after, str):
+                after = [after]
+            for x in after:
+                if x not in stages or x == name:
+                    raise ValueError("Unknown stage %s after %s." % (x, name))
+            commands[name] = value
+            parents[name] = list(after)
+        # Topological order that keeps the order of declaration where possible
+        plan = []
+        done = set()
+        while len(plan) < len(names):
+            ready = [x for x in names if x not in done and all(y in done for y in parents[x])]
+            if len(ready) == 0:
+                raise ValueError("Stages have cyclic dependencies.")
+            plan.append((ready[0], commands[ready[0]], parents[ready[0]]))
+            done.add(ready[0])
+        return plan
+
+    @staticmethod
+    def _get_stage_properties(submit_properties, parent_ids, array):
+        """Submit properties with dependency on the parent submissions, None if a parent was not submitted."""
+        if any(x is None for x in parent_ids):
+            return None
+        properties = dict(submit_properties)
+        if len(parent_ids) > 0:
+            properties['--dependency'] = ("aftercorr:" if array else "afterok:") + ":".join(parent_ids)
+            properties['--kill-on-invalid-dep'] = "yes"
+        return properties
+
+    def _prepare_run(self, jobs, procs, asyn, header, command, command_arguments, queue_properties, array,
+                     array_limit, worker, pool, cost, telemetry, markers, manifest, stage=None):
+        """Write the scripts for run() and return the list of script names to submit, see run()."""
         # Get Paths
         sub_jobs = self.get(jobs)
         sub_keys = list(sub_jobs.keys())
-        sub_cmd = [sub_jobs[x]['command'] if 'command' in sub_jobs[x] else command for x in sub_keys]
+        if stage is not None:
+            sub_cmd = [sub_jobs[x]['stages'][stage] if stage in sub_jobs[x].get('stages', {}) else command
+                       for x in sub_keys]
+        else:
+            sub_cmd = [sub_jobs[x]['command'] if 'command' in sub_jobs[x] else command for x in sub_keys]
         sub_path = [{y: sub_jobs[x][y] for y in command_arguments if y in sub_jobs[x]} for x in sub_keys]
 
         # Get job array size
@@ -346,55 +843,638 @@ class MultiJobDirectory(object):
         num_procs = min(len_jobs, procs)
         len_per_array = len_jobs // num_procs + (len_jobs % num_procs > 0)
 
+        # Job chunks per script or array task
+        if cost is not None:
+            costs = self._get_job_costs(sub_jobs, cost)
+            chunks = self._balance_jobs(costs, num_procs)
+            order = sorted(range(len_jobs), key=lambda x: costs[x], reverse=True)
+        else:
+            chunks = [list(range(i, min(i + len_per_array, len_jobs))) for i in range(0, len_jobs, len_per_array)]
+            order = list(range(len_jobs))
+
+        # Submit workers on a task queue
+        if worker:
+            num = self._get_free_bash_index()
+            bash_submit = "%s_%i.sh" % (self.dirname, num)
+            queuedir = os.path.join(self.dirmain, "%s_%i%s" % (self.dirname, num, self.taskqueue_ending))
+            if self.submit_type == "SLURM":
+                self._set_job_script(sub_keys, bash_submit, stage)
+                make_task_queue(queuedir, [sub_keys[j] for j in order], [sub_path[j] for j in order],
+                                [sub_cmd[j] for j in order])
+                make_slurm_worker_script(self.dirmain, bash_submit, queuedir, asyn,
+                                         header=header,
+                                         slurm_variables=queue_properties,
+                                         array_size=num_procs if array else 0,
+                                         array_limit=array_limit,
+                                         telemetry=telemetry,
+                                         markers=markers
+                                         )
+            return [bash_submit] * (1 if array else num_procs)
+
+        # Submit slurm array
+        if array:
+            num = self._get_free_bash_index()
+            bash_submit = "%s_%i.sh" % (self.dirname, num)
+            self._set_job_script(sub_keys, bash_submit, stage)
+            if self.submit_type == "SLURM":
+                make_slurm_array_script(self.dirmain, bash_submit, asyn,
+                                        [[sub_keys[j] for j in x] for x in chunks],
+                                        [[sub_path[j] for j in x] for x in chunks],
+                                        [[sub_cmd[j] for j in x] for x in chunks],
+                                        header=header,
+                                        slurm_variables=queue_properties,
+                                        array_limit=array_limit,
+                                        pool=pool,
+                                        telemetry=telemetry,
+                                        markers=markers,
+                                        manifest=manifest,
+                                        exit_failed=stage is not None
+                                        )
+            return [bash_submit]
+
         # Submit slurms
-        id_list = []
-        for i in range(0, len_jobs, len_per_array):
+        scripts = []
+        for chunk in chunks:
             num = self._get_free_bash_index()
             bash_submit = "%s_%i.sh" % (self.dirname, num)
+            self._set_job_script([sub_keys[j] for j in chunk], bash_submit, stage)
             if self.submit_type == "SLURM":
                 make_slurm_script(self.dirmain, bash_submit, asyn,
-                                  sub_keys[i:i + len_per_array],
-                                  sub_path[i:i + len_per_array],
-                                  sub_cmd[i:i + len_per_array],
+                                  [sub_keys[j] for j in chunk],
+                                  [sub_path[j] for j in chunk],
+                                  [sub_cmd[j] for j in chunk],
                                   header=header,
-                                  slurm_variables=queue_properties
+                                  slurm_variables=queue_properties,
+                                  pool=pool,
+                                  telemetry=telemetry,
+                                  markers=markers,
+                                  manifest=manifest,
+                                  exit_failed=stage is not None
                                   )
-            if not prepare_only:
-                if self.submit_type == "SLURM":
-                    id_sub = make_slurm_sub(self.dirmain, bash_submit,
-                                            submit_properties)
-                    id_list.append(id_sub)
-                    # submits
-        return id_list
+            scripts.append(bash_submit)
+        return scripts
+
+    @contextlib.contextmanager
+    def _edit_backlog(self):
+        """Context manager to read and atomically write the submission backlog under a file lock."""
+        with file_lock(os.path.join(self.dirmain, self.backlog_name) + ".lock"):
+            backlog = self._read_backlog()
+            yield backlog
+            self._write_backlog(backlog)
+
+    def _read_backlog(self):
+        """Read the submission backlog. Requires lock."""
+        backlog = self._read_json_from_file(os.path.join(self.dirmain, self.backlog_name))
+        if backlog is None:
+            backlog = {"max_in_flight": 0, "scripts": [], "failed": []}
+        return backlog
+
+    def _write_backlog(self, backlog):
+        """Atomically write the submission backlog. Requires lock."""
+        backlog_path = os.path.join(self.dirmain, self.backlog_name)
+        temppath = "%s.%i.tmp" % (backlog_path, os.getpid())
+        self._write_json_to_file(backlog, temppath)
+        os.replace(temppath, backlog_path)
+
+    def _add_to_backlog(self, scripts, submit_properties, max_in_flight):
+        with self._edit_backlog() as backlog:
+            backlog["max_in_flight"] = max_in_flight
+            backlog["scripts"] += [{"script": x, "submit_properties": submit_properties} for x in scripts]
+
+    def _update_backlog(self, backlog, id_sub, error):
+        """Remove the first script of the backlog after a submission attempt and return whether to continue."""
+        entry = backlog["scripts"][0]
+        if error is None:
+            backlog["scripts"].pop(0)
+            return True
+        if is_slurm_limit_error(error):
+            print("Info: Submission limit reached, %i scripts remain in backlog." % len(backlog["scripts"]))
+            return False
+        print("Error: Submission of %s failed: %s" % (entry["script"], error))
+        entry["error"] = error
+        backlog["failed"].append(backlog["scripts"].pop(0))
+        return True
+
+    def backlog(self):
+        """
+        Get the submission backlog of run(max_in_flight=...).
+
+        Returns:
+            backlog (dict): With 'max_in_flight', 'scripts' waiting for submission and 'failed' scripts including
+                            the 'error' of the submission.
+        """
+        with file_lock(os.path.join(self.dirmain, self.backlog_name) + ".lock", shared=True):
+            return self._read_backlog()
+
+    def submit_backlog(self, max_in_flight=None):
+        """
+        Submit scripts of the backlog until max_in_flight submissions of this directory are in the queue.
+        A job array counts as one submission. Scripts that are rejected due to a limit of the queueing system stay
+        in the backlog, scripts that fail for other reasons are moved to the failed list of backlog().
+        The backlog is stored in the main directory, so that submission can continue after a restart.
+
+        Args:
+            max_in_flight (int): Maximum number of submissions in the queue. Default is None, the stored value.
+
+        Returns:
+            queue_ids (list): Ids of the submitted scripts.
+        """
+        submitted = []
+        if self.submit_type != "SLURM":
+            return submitted
+        with self._edit_backlog() as backlog:
+            if max_in_flight is not None:
+                backlog["max_in_flight"] = max_in_flight
+            if len(backlog["scripts"]) == 0:
+                return submitted
+            list_ids, _ = self.queue(print_level=0, max_age=0)
+            in_flight = len(set(split_slurm_id(x)[0] for x in list_ids))
+            while len(backlog["scripts"]) > 0 and (backlog["max_in_flight"] <= 0 or
+                                                   in_flight < backlog["max_in_flight"]):
+                entry = backlog["scripts"][0]
+                id_sub, error = submit_slurm_script(self.dirmain, entry["script"], entry["submit_properties"])
+                if not self._update_backlog(backlog, id_sub, error):
+                    break
+                if error is None:
+                    submitted.append(id_sub)
+                    in_flight += 1
+        return submitted
+
+    def drain_backlog(self, max_in_flight=None, poll_interval=60.0, timeout=None):
+        """
+        Block and submit the backlog via submit_backlog() as submissions leave the queue until it is empty.
+
+        Args:
+            max_in_flight (int): Maximum number of submissions in the queue. Default is None, the stored value.
+            poll_interval (float): Time between checks of the queue in seconds. Default is 60.
+            timeout (float): Maximum time to wait in seconds. Default is None, no limit.
+
+        Returns:
+            queue_ids (list): Ids of the submitted scripts.
+        """
+        submitted = []
+        start = time.monotonic()
+        while True:
+            submitted += self.submit_backlog(max_in_flight)
+            if len(self.backlog()["scripts"]) == 0:
+                return submitted
+            if timeout is not None and time.monotonic() - start + poll_interval > timeout:
+                print("Warning: Backlog not empty after %s seconds." % timeout)
+                return submitted
+            time.sleep(poll_interval)
+
+    def runtimes(self, jobs=0, update_jobinfo=True):
+        """
+        Merge the telemetry records written by the scripts of run() into a per-job runtime table.
+        For each job the latest record is taken.
+
+        Args:
+            jobs (str,list,int): Job names to get runtimes for. Same as in get(). Default is 0, all jobs.
+            update_jobinfo (bool): Whether to store the runtime of successful jobs as 'runtime' in jobinfo,
+                                   which can be used as cost estimate in run(cost='runtime'). Default is True.
+
+        Returns:
+            runtimes (dict): Record per job with script, job_id, array_task, node, start, end, exit,
+                             maxrss_kb (only for run(telemetry='maxrss')) and runtime in seconds.
+        """
+        sub_jobs = self.get(jobs)
+        runtimes = {}
+        for x in read_slurm_telemetry(self.dirmain):
+            job = x.get('job')
+            if job not in sub_jobs:
+                continue
+            if job in runtimes and runtimes[job]['end'] > x['end']:
+                continue
+            x['runtime'] = x['end'] - x['start']
+            runtimes[job] = x
+        if update_jobinfo:
+            for key, value in runtimes.items():
+                if value['exit'] == 0:
+                    self.jobinfo[key]['runtime'] = value['runtime']
+        return runtimes
+
+    def collect(self, parser, jobs=0, workers=None, processes=True, chunksize=64, ordered=False):
+        """
+        Apply a parser like read_homo_lumo(path) to the directories of jobs in parallel and stream the results.
+
+        Jobs are handed to a process or thread pool in chunks and results are yielded as the chunks finish, so that
+        only a bounded number of results is held in memory. Exceptions of the parser are caught per job and returned
+        as error message instead of stopping the harvest.
+
+        Args:
+            parser (callable): Function f(path) that reads the output of a job directory.
+                               For processes it must be picklable, i.e. defined at module level.
+            jobs (str,list,int): Job names to collect. Same as in get(). Default is 0, all jobs.
+            workers (int): Number of processes or threads. Default is None, the number of cpus.
+            processes (bool): Whether to use a process pool instead of a thread pool. A thread pool is used if the
+                              parser can not be pickled. Default is True.
+            chunksize (int): Number of jobs per task of the pool. Default is 64.
+            ordered (bool): Whether to yield results in order of the jobs instead of as they finish. Default is False.
+
+        Yields:
+            tuple: Job name, result of the parser (None on error) and error message (None on success).
+        """
+        items = [(key, value['path']) for key, value in self.get(jobs).items()]
+        chunksize = max(int(chunksize), 1)
+        chunks = [items[i:i + chunksize] for i in range(0, len(items), chunksize)]
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if workers <= 1 or len(chunks) <= 1:
+            for chunk in chunks:
+                for x in _parse_job_chunk(parser, chunk):
+                    yield x
+            return
+        if processes:
+            try:
+                pickle.dumps(parser)
+            except (pickle.PicklingError, AttributeError, TypeError):
+                print("Warning: Parser can not be pickled, using threads instead of processes.")
+                processes = False
+        pool_type = ProcessPoolExecutor if processes else ThreadPoolExecutor
+        max_pending = 2 * workers
+        pending = []
+        with pool_type(max_workers=workers) as executor:
+            try:
+                for chunk in chunks:
+                    pending.append(executor.submit(_parse_job_chunk, parser, chunk))
+                    if len(pending) < max_pending:
+                        continue
+                    done, pending = self._wait_for_chunks(pending, ordered)
+                    for future in done:
+                        for x in future.result():
+                            yield x
+                while len(pending) > 0:
+                    done, pending = self._wait_for_chunks(pending, ordered)
+                    for future in done:
+                        for x in future.result():
+                            yield x
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    @staticmethod
+    def _wait_for_chunks(pending, ordered):
+        """Wait for the next finished futures of collect(), the first one in order if ordered."""
+        if ordered:
+            pending[0].result()
+            return pending[:1], pending[1:]
+        done, not_done = wait(pending, return_when=FIRST_COMPLETED)
+        return [x for x in pending if x in done], [x for x in pending if x in not_done]
+
+    def collect_results(self, parser, jobs=0, workers=None, processes=True, chunksize=64, column=None,
+                        batch_size=10000):
+        """
+        Collect parser results of jobs into the columnar results table of the directory, see collect() and
+        ResultsTable. Results are appended in batches as they arrive and jobs with parse errors are marked invalid.
+
+        Args:
+            parser (callable): Function f(path) that returns a dict of quantities like read_xtb_output(), or a
+                               single value if column is given.
+            jobs (str,list,int): Job names to collect. Same as in get(). Default is 0, all jobs.
+            workers (int): Number of processes or threads. Default is None, the number of cpus.
+            processes (bool): Whether to use a process pool instead of a thread pool. Default is True.
+            chunksize (int): Number of jobs per task of the pool. Default is 64.
+            column (str): Store the result of the parser in this column. Default is None.
+            batch_size (int): Number of results written to the table at once. Default is 10000.
+
+        Returns:
+            errors (dict): Job name to error message for jobs that could not be parsed.
+        """
+        errors = {}
+        batch = {}
+        for name, result, error in self.collect(parser, jobs=jobs, workers=workers, processes=processes,
+                                                chunksize=chunksize):
+            if error is None and column is not None:
+                result = {column: result}
+            elif error is None and not isinstance(result, dict):
+                error = "TypeError: Parser must return a dict if no column is given."
+            if error is not None:
+                errors[name] = error
+                result = {}
+            batch[name] = result
+            if len(batch) >= batch_size:
+                self.results.append(batch)
+                batch = {}
+        self.results.append(batch)
+        if len(errors) > 0:
+            print("Warning: Failed to parse %i jobs." % len(errors))
+        return errors
+
+    def cached(self, parser, filenames, name=None, version=0):
+        """
+        Make a parser f(path) that keeps its results in a cache in the main directory, see ResultCache.
+
+        A job is only parsed again if size, modification time or inode of one of its output files changed.
+        The cached parser can be used in collect() like the parser itself.
+
+        Args:
+            parser (callable): Function f(path) that reads the output of a job directory, e.g. read_homo_lumo.
+            filenames (str,list): Output files in the job directory read by the parser, e.g. 'output.txt'.
+            name (str): Name of the parser in the cache. Default is None, the module and name of the function.
+            version (int,str): Version of the parser. Change it to invalidate results of a modified parser.
+                               Default is 0.
+
+        Returns:
+            CachedParser: Function f(path) that returns the cached or parsed result.
+        """
+        return self.result_cache.wrap(parser, filenames, name=name, version=version)
+
+    def invalidate_results(self, jobs=0, parser=None):
+        """
+        Remove cached results of cached() parsers.
+
+        Args:
+            jobs (str,list,int): Job names to remove results for. Same as in get(). Default is 0, all jobs.
+            parser (str,callable): Parser, cached parser or its name. Default is None, all parsers.
+
+        Returns:
+            int: Number of removed results.
+        """
+        if isinstance(jobs, int) and jobs == 0:
+            return self.result_cache.invalidate(parser=parser)
+        return self.result_cache.invalidate([x['path'] for x in self.get(jobs).values()], parser=parser)
+
+    def collect_array(self, parser, jobs=0, workers=None, processes=True, chunksize=64, fill_value=float("nan"),
+                      dtype=float):
+        """
+        Collect parser results of jobs into a numpy array indexed by the position of the job, see collect().
 
-    def queue(self, print_level=2):
+        The parser must return a number or a sequence of numbers of the same length for every job,
+        e.g. (homo, lumo). Rows of jobs with parse errors are set to fill_value.
+
+        Args:
+            parser (callable): Function f(path) that reads the output of a job directory.
+            jobs (str,list,int): Job names to collect. Same as in get(). Default is 0, all jobs.
+            workers (int): Number of processes or threads. Default is None, the number of cpus.
+            processes (bool): Whether to use a process pool instead of a thread pool. Default is True.
+            chunksize (int): Number of jobs per task of the pool. Default is 64.
+            fill_value: Value for jobs with parse errors. Default is nan.
+            dtype: Data type of the array. Default is float.
+
+        Returns:
+            names, values, errors (tuple): List of job names, array of shape (len(names), ...) with the results
+                                           in order of names and dict of job name to error message.
+        """
+        import numpy as np
+        names = list(self.get(jobs).keys())
+        index = {x: i for i, x in enumerate(names)}
+        values = None
+        errors = {}
+        for name, result, error in self.collect(parser, jobs=names, workers=workers, processes=processes,
+                                                chunksize=chunksize):
+            if error is None:
+                try:
+                    result = np.asarray(result, dtype=dtype)
+                    if values is None:
+                        values = np.full((len(names),) + result.shape, fill_value, dtype=dtype)
+                    if result.shape != values.shape[1:]:
+                        raise ValueError("Shape %s does not match %s." % (result.shape, values.shape[1:]))
+                    values[index[name]] = result
+                    continue
+                except (ValueError, TypeError) as e:
+                    error = "%s: %s" % (type(e).__name__, e)
+            errors[name] = error
+        if values is None:
+            values = np.full((len(names),), fill_value, dtype=dtype)
+        if len(errors) > 0:
+            print("Warning: Failed to parse %i of %i jobs." % (len(errors), len(names)))
+        return names, values, errors
+
+    def status(self, jobs=0, state=None, use_queue=True):
+        """
+        Get the state of jobs from the state markers written by the scripts of run() and the queue.
+
+        The states are: 'new' (never submitted), 'backlog' (script waiting for submission, see submit_backlog()),
+        'submitted' (script not in queue and job never started), 'queued' (script in queue but job not yet started),
+        'running', 'done' and 'failed' (non-zero exit code or script left the queue while the job was running).
+
+        Args:
+            jobs (str,list,int): Job names to get state for. Same as in get(). Default is 0, all jobs.
+            state (str): If given, only job names with this state are returned as list,
+                         e.g. run(jobs=status(state='failed')). Default is None.
+            use_queue (bool): Whether to check the queueing system for queued scripts. Default is True.
+
+        Returns:
+            status (dict,list): Job name to state or list of job names if state is given.
+        """
+        sub_jobs = self.get(jobs)
+        # Queue before state markers, so that a script that left the queue has written all its markers.
+        scripts_in_queue = set()
+        if use_queue:
+            _, scripts_in_queue = self.queue(print_level=0)
+            scripts_in_queue = set(scripts_in_queue)
+        return self._make_status(sub_jobs, scripts_in_queue, use_queue, state, self.backlog()["scripts"])
+
+    def _make_status(self, sub_jobs, scripts_in_queue, use_queue, state, backlog_scripts):
+        """Read state markers and make the return value of status() with the scripts of the backlog."""
+        states = read_slurm_states(self.dirmain)
+        backlog_scripts = set(x["script"] for x in backlog_scripts)
+        status = {}
+        for key, value in sub_jobs.items():
+            status[key] = self._get_job_state(key, value.get('script'), states, scripts_in_queue, use_queue,
+                                              backlog_scripts)
+        if state is not None:
+            return [key for key, value in status.items() if value == state]
+        return status
+
+    def as_completed(self, jobs=0, timeout=None, poll_interval=1.0, max_interval=60.0):
+        """
+        Iterate over jobs as they finish, i.e. reach the state 'done' or 'failed' of status().
+
+        Waits for changes of the state markers of the scripts via inotify if available and otherwise polls
+        with an interval that doubles from poll_interval up to max_interval while no job finishes.
+        Since inotify does not report writes from other nodes on network filesystems, the state markers are
+        always re-read at least every max_interval. Jobs that were never submitted are skipped. Jobs of scripts
+        that left the queue without starting the job are reported as 'failed' if the script was seen in the queue.
+
+        Args:
+            jobs (str,list,int): Job names to wait for. Same as in get(). Default is 0, all jobs.
+            timeout (float): Maximum time to wait in seconds. Default is None, no limit.
+            poll_interval (float): Initial polling interval in seconds. Default is 1.
+            max_interval (float): Maximum polling interval in seconds. Default is 60.
+
+        Yields:
+            tuple: Job name and state ('done' or 'failed').
+
+        Raises:
+            TimeoutError: If not all jobs finished within timeout.
+        """
+        scripts, pending = self._get_submitted_scripts(jobs)
+        offsets = {}
+        states = {}
+        scripts_in_queue = set()
+        seen_scripts = set()
+        last_queue = None
+        interval = poll_interval
+        start = time.monotonic()
+        with DirectoryWatcher(self.dirmain) as watcher:
+            while len(pending) > 0:
+                # Queue is only needed to detect jobs of scripts that left the queue and is read before the markers.
+                if last_queue is None or time.monotonic() - last_queue >= poll_interval:
+                    _, scripts_in_queue = self.queue(print_level=0)
+                    scripts_in_queue = set(scripts_in_queue)
+                    seen_scripts.update(scripts_in_queue)
+                    last_queue = time.monotonic()
+                read_slurm_states(self.dirmain, offsets=offsets, states=states)
+                finished, pending = self._split_completed(pending, scripts, states, scripts_in_queue, seen_scripts)
+                for x in finished:
+                    yield x
+                interval = poll_interval if len(finished) > 0 else min(2 * interval, max_interval)
+                if len(pending) > 0:
+                    watcher.wait(self._get_wait_time(interval, timeout, start, len(pending)))
+
+    def wait(self, jobs=0, timeout=None, poll_interval=1.0, max_interval=60.0):
+        """
+        Block until jobs finished, see as_completed().
+
+        Args:
+            jobs (str,list,int): Job names to wait for. Same as in get(). Default is 0, all jobs.
+            timeout (float): Maximum time to wait in seconds. Default is None, no limit.
+            poll_interval (float): Initial polling interval in seconds. Default is 1.
+            max_interval (float): Maximum polling interval in seconds. Default is 60.
+
+        Returns:
+            status (dict): Job name to state of finished jobs. Jobs missing did not finish within timeout.
+        """
+        finished = {}
+        try:
+            for key, job_state in self.as_completed(jobs, timeout=timeout, poll_interval=poll_interval,
+                                                    max_interval=max_interval):
+                finished[key] = job_state
+        except TimeoutError as e:
+            print("Warning:", e)
+        return finished
+
+    def _get_submitted_scripts(self, jobs):
+        """Get scripts of jobs and the list of submitted jobs for as_completed()."""
+        scripts = {key: value.get('script') for key, value in self.get(jobs).items()}
+        pending = [key for key, value in scripts.items() if value is not None]
+        if len(pending) < len(scripts):
+            print("Warning: Skipping %i jobs that were never submitted." % (len(scripts) - len(pending)))
+        return scripts, pending
+
+    def _split_completed(self, pending, scripts, states, scripts_in_queue, seen_scripts):
+        """Split pending jobs into a list of finished (name, state) and still pending names."""
+        finished = []
+        still_pending = []
+        for key in pending:
+            job_state = self._get_job_state(key, scripts[key], states, scripts_in_queue, True)
+            if job_state == 'submitted' and scripts[key] in seen_scripts:
+                job_state = 'failed'
+            if job_state in ('done', 'failed'):
+                finished.append((key, job_state))
+            else:
+                still_pending.append(key)
+        return finished, still_pending
+
+    @staticmethod
+    def _get_wait_time(interval, timeout, start, num_pending):
+        """Limit interval to the remaining time of timeout or raise TimeoutError."""
+        if timeout is None:
+            return interval
+        remaining = timeout - (time.monotonic() - start)
+        if remaining <= 0:
+            raise TimeoutError("%i jobs did not finish within %s seconds." % (num_pending, timeout))
+        return min(interval, remaining)
+
+    @staticmethod
+    def _get_job_state(name, script, states, scripts_in_queue, use_queue, backlog_scripts=()):
+        """Get the state of a single job from state markers and scripts in queue, see status()."""
+        if name in states and (script is None or states[name][3] == script):
+            job_state = states[name][0]
+            if job_state == 'running' and use_queue and script not in scripts_in_queue:
+                job_state = 'failed'
+        elif script is None:
+            job_state = 'new'
+        elif script in backlog_scripts:
+            job_state = 'backlog'
+        elif script in scripts_in_queue:
+            job_state = 'queued'
+        else:
+            job_state = 'submitted'
+        return job_state
+
+    def queue(self, print_level=2, max_age=None):
         """ 
         Function to check queueing system. Should be quite unique for this directory and safely get jobs. 
+        The queue information is cached and shared by all directories of the process, so that polling many
+        directories only requires one squeue call per interval.
 
         Args:
             print_level (int): print information, high-level more printing, 0 means no print
+            max_age (float): Maximum age of cached queue information in seconds. Use 0 to force a new query.
+                             Default is None, the ttl of the cache of 10 seconds.
         
         Returns:
-            list_ids,list_scripts (tuple): list of ids, running scripts
+            list_ids,list_scripts (tuple): list of ids, running scripts.
+                                           Tasks of job arrays have ids like 12345_7.
         """
         # Check slurm
         list_ids = []
         list_scripts = []
         if self.submit_type == "SLURM":
-            list_ids, list_scripts = make_slurm_queue(self.dirmain, print_level=print_level)
+            list_ids, list_scripts = make_slurm_queue(self.dirmain, print_level=print_level, max_age=max_age)
 
         return list_ids, list_scripts
 
-    def cancel(self, ids=[]):
+    def accounting(self, ids=[]):
+        """
+        Look up state and exit code of finished or running jobs by queue id, e.g. ids returned by run().
+
+        Args:
+            ids (str,list): Queue ids. Can be single string, list of ids or int.
+
+        Returns:
+            accounting (dict): Queue id to dict with name, state and exit_code.
+        """
+        if isinstance(ids, (str, int)):
+            ids = [ids]
+        if self.submit_type == "SLURM":
+            return make_slurm_accounting(ids)
+        return {}
+
+    def cancel(self, ids=[], jobs=None, scripts=None, state=None, batch_size=1000):
         """ 
-        Rudimental function to cancel queueing by id.
+        Cancel queueing by id or by a selection of jobs.
+
+        Jobs are mapped to queue ids via the script that run() recorded for each job. Note that the whole script is
+        cancelled, including other jobs of the same script. All tasks of a selected job array are cancelled at once
+        via the array id. Ids are passed to the queueing system in batches.
         
         Args:
             ids (str,list): queue ids to cancel. Can be single string, list of ids or int.
-        
+                            Array tasks are given like 12345_7, the array id 12345 cancels all tasks.
+                            None entries, e.g. failed submissions of run(), are ignored.
+            jobs (str,list,int): Cancel the scripts of these jobs. Same selection as in get(). Default is None.
+            scripts (str,list): Cancel these scripts by name like 'Name_3.sh'. Default is None.
+            state (str): Only cancel the scripts of jobs with this state of status(), e.g. 'queued' or 'running'.
+                         Selects from all jobs if jobs is None. Default is None.
+            batch_size (int): Maximum number of ids per call of the queueing system. Default is 1000.
+
+        Returns:
+            cancelled (list): Queue ids that were cancelled.
         """
-        if isinstance(ids, str):
+        if isinstance(ids, (str, int)):
             ids = [ids]
+        ids = [str(x) for x in ids if x is not None]
         if self.submit_type == "SLURM":
-            for x in ids:
-                _ = subprocess.run(['scancel', x], capture_output=True)
+            if jobs is not None or scripts is not None or state is not None:
+                list_ids, list_scripts = self.queue(print_level=0, max_age=0)
+                if state is not None:
+                    jobs = self.status(0 if jobs is None else jobs, state=state)
+                ids += self._get_script_ids(jobs, scripts, list_ids, list_scripts)
+            return make_slurm_cancel(ids, batch_size=batch_size)
+        return []
+
+    def _get_script_ids(self, jobs, scripts, list_ids, list_scripts):
+        """Map a selection of jobs and scripts to the queue ids of the scripts, array tasks to the array id."""
+        if isinstance(scripts, str):
+            scripts = [scripts]
+        selected = set() if scripts is None else set(scripts)
+        if jobs is not None and not (isinstance(jobs, (list, tuple, set, dict)) and len(jobs) == 0):
+            selected.update(x['script'] for x in self.get(jobs).values() if x.get('script') is not None)
+        script_ids = {}
+        for queue_id, script in zip(list_ids, list_scripts):
+            if script in selected:
+                script_ids[split_slurm_id(queue_id)[0]] = None
+        return list(script_ids.keys())
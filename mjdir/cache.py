@@ -0,0 +1,236 @@
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+
+def get_parser_name(parser):
+    """Name of a parser function for the cache key, e.g. 'mjdir.commands.xtb.read_homo_lumo'.
+    Arguments of functools.partial are included."""
+    func = getattr(parser, "func", None)
+    if func is not None:
+        arguments = [repr(x) for x in getattr(parser, "args", ())]
+        arguments += ["%s=%r" % (key, value) for key, value in sorted(getattr(parser, "keywords", {}).items())]
+        return "%s(%s)" % (get_parser_name(func), ", ".join(arguments))
+    return "%s.%s" % (getattr(parser, "__module__", None),
+                      getattr(parser, "__qualname__", getattr(parser, "__name__", type(parser).__name__)))
+
+
+def get_file_fingerprint(path, filenames):
+    """
+    Fingerprint of output files in a job directory from size, modification time and inode.
+
+    Args:
+        path (str): Job directory.
+        filenames (list): Names of the files in the job directory.
+
+    Returns:
+        str: Fingerprint or None if a file does not exist.
+    """
+    parts = []
+    for x in filenames:
+        try:
+            stat = os.stat(os.path.join(path, x))
+        except OSError:
+            return None
+        parts.append("%i:%i:%i" % (stat.st_size, stat.st_mtime_ns, stat.st_ino))
+    return ";".join(parts)
+
+
+class ResultCache(object):
+    """Cache of parsed results in a sqlite database, keyed by job directory and parser name.
+
+    A result is valid as long as the parser version and size, modification time and inode of the output files of
+    the job did not change, so that only changed outputs are parsed again. Results must be picklable. Entries not
+    used for the longest time are evicted above max_entries, which is checked every 1000 stored results.
+    Each thread and process opens its own connection, so that a cache can be passed to a process pool.
+    Like the sqlite storage, all processes must be on the same host.
+    """
+
+    def __init__(self, filepath, max_entries=1000000, touch_interval=3600.0):
+        """Initialize cache. The database is created on first use.
+
+        Args:
+            filepath (str): Path of the database file.
+            max_entries (int): Maximum number of cached results. Default is 1000000.
+            touch_interval (float): Minimum time in seconds before the last use of an entry is updated on a hit.
+                                    This avoids a write for every hit. Default is 3600.
+        """
+        self.filepath = filepath
+        self.max_entries = max_entries
+        self.touch_interval = touch_interval
+        self._local = threading.local()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_local"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    def _connect(self):
+        """Connection of the current thread and process."""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        conn = sqlite3.connect(self.filepath, timeout=60)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        with conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS results (job TEXT, parser TEXT, fingerprint TEXT, value BLOB, "
+                         "used REAL, PRIMARY KEY (job, parser))")
+            conn.execute("CREATE INDEX IF NOT EXISTS results_used ON results (used)")
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        self._local.num_set = 0
+        return conn
+
+    def get(self, job, parser, fingerprint):
+        """
+        Look up a result.
+
+        Args:
+            job (str): Job directory.
+            parser (str): Name of the parser.
+            fingerprint (str): Version of the parser and fingerprint of the output files, see get_file_fingerprint().
+
+        Returns:
+            found, value (tuple): Whether a valid result was found and the result.
+        """
+        conn = self._connect()
+        row = conn.execute("SELECT fingerprint, value, used FROM results WHERE job = ? AND parser = ?",
+                           (job, parser)).fetchone()
+        if row is None or row[0] != fingerprint:
+            return False, None
+        now = time.time()
+        if now - row[2] > self.touch_interval:
+            with conn:
+                conn.execute("UPDATE results SET used = ? WHERE job = ? AND parser = ?", (now, job, parser))
+        return True, pickle.loads(row[1])
+
+    def set(self, job, parser, fingerprint, value):
+        """
+        Store a result and evict old entries above max_entries.
+
+        Args:
+            job (str): Job directory.
+            parser (str): Name of the parser.
+            fingerprint (str): Version of the parser and fingerprint of the output files, see get_file_fingerprint().
+            value: Result of the parser.
+        """
+        conn = self._connect()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO results (job, parser, fingerprint, value, used) "
+                         "VALUES (?, ?, ?, ?, ?)",
+                         (job, parser, fingerprint, sqlite3.Binary(pickle.dumps(value)), time.time()))
+        self._local.num_set += 1
+        if self._local.num_set % 1000 == 0:
+            self.evict()
+
+    def evict(self, max_entries=None):
+        """
+        Remove the least recently used entries above max_entries.
+
+        Args:
+            max_entries (int): Number of entries to keep. Default is None, the max_entries of the cache.
+
+        Returns:
+            int: Number of removed entries.
+        """
+        if max_entries is None:
+            max_entries = self.max_entries
+        conn = self._connect()
+        num_remove = len(self) - max_entries
+        if num_remove <= 0:
+            return 0
+        with conn:
+            conn.execute("DELETE FROM results WHERE rowid IN (SELECT rowid FROM results ORDER BY used LIMIT ?)",
+                         (num_remove,))
+        return num_remove
+
+    def invalidate(self, jobs=None, parser=None):
+        """
+        Remove cached results.
+
+        Args:
+            jobs (list): Job directories. Default is None, all jobs.
+            parser (str,callable): Parser or its name. Default is None, all parsers.
+
+        Returns:
+            int: Number of removed entries.
+        """
+        if isinstance(parser, CachedParser):
+            parser = parser.name
+        elif parser is not None and not isinstance(parser, str):
+            parser = get_parser_name(parser)
+        parser_condition = "" if parser is None else " AND parser = ?"
+        parser_args = [] if parser is None else [parser]
+        conn = self._connect()
+        with conn:
+            if jobs is None:
+                cursor = conn.execute("DELETE FROM results WHERE 1" + parser_condition, parser_args)
+                return cursor.rowcount
+            removed = 0
+            for x in jobs:
+                cursor = conn.execute("DELETE FROM results WHERE job = ?" + parser_condition, [x] + parser_args)
+                removed += cursor.rowcount
+        return removed
+
+    def wrap(self, parser, filenames, name=None, version=0):
+        """
+        Make a cached version of a parser f(path), see CachedParser.
+
+        Args:
+            parser (callable): Function f(path) that reads the output of a job directory.
+            filenames (str,list): Output files in the job directory read by the parser.
+            name (str): Name of the parser. Default is None, the module and name of the function.
+            version (int,str): Version of the parser. Change it to invalidate results of a modified parser.
+                               Default is 0.
+
+        Returns:
+            CachedParser: Function f(path) that returns the cached or parsed result.
+        """
+        return CachedParser(self, parser, filenames, name=name, version=version)
+
+    def __len__(self):
+        return self._connect().execute("SELECT count(*) FROM results").fetchone()[0]
+
+    def close(self):
+        """Close the connection of the current thread."""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and self._local.pid == os.getpid():
+            conn.close()
+        self._local.conn = None
+
+
+class CachedParser(object):
+    """Parser f(path) that returns the result from a ResultCache if the output files did not change.
+
+    Exceptions of the parser are not cached, so that incomplete outputs of running jobs are parsed again.
+    The cached parser can be pickled for a process pool if the parser can be pickled.
+    """
+
+    def __init__(self, cache, parser, filenames, name=None, version=0):
+        """Initialize cached parser, see ResultCache.wrap()."""
+        if isinstance(filenames, str):
+            filenames = [filenames]
+        self.cache = cache
+        self.parser = parser
+        self.filenames = list(filenames)
+        self.name = get_parser_name(parser) if name is None else name
+        self.version = version
+
+    def __call__(self, path):
+        fingerprint = get_file_fingerprint(path, self.filenames)
+        if fingerprint is None:
+            return self.parser(path)
+        fingerprint = "%s;%s" % (self.version, fingerprint)
+        found, value = self.cache.get(path, self.name, fingerprint)
+        if found:
+            return value
+        value = self.parser(path)
+        self.cache.set(path, self.name, fingerprint, value)
+        return value
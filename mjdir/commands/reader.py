@@ -0,0 +1,106 @@
+import os
+
+
+def read_tail_lines(filepath, block_size=65536, max_bytes=None):
+    """
+    Iterate over the lines of a file from the end to the beginning by reading blocks backwards.
+
+    Only the blocks needed are read, so that reading the last lines of a large output is independent of the
+    length of the file.
+
+    Args:
+        filepath (str): Path of the file.
+        block_size (int): Number of bytes read at once. Default is 65536.
+        max_bytes (int): Stop after reading this number of bytes from the end. Default is None, the whole file.
+
+    Yields:
+        str: Lines without line ending, last line first.
+    """
+    with open(filepath, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        position = end
+        remainder = b""
+        while position > 0:
+            if max_bytes is not None and end - position >= max_bytes:
+                return
+            size = min(block_size, position)
+            if max_bytes is not None:
+                size = min(size, max_bytes - (end - position))
+            position -= size
+            f.seek(position)
+            lines = (f.read(size) + remainder).split(b"\n")
+            remainder = lines[0]
+            for line in reversed(lines[1:]):
+                yield line.decode("utf-8", errors="replace").rstrip("\r")
+        yield remainder.decode("utf-8", errors="replace").rstrip("\r")
+
+
+def find_in_tail(filepath, extractors, block_size=65536, max_bytes=None):
+    """
+    Apply extractors to the lines of a file from the end and stop as soon as every extractor found its value.
+
+    Args:
+        filepath (str): Path of the file.
+        extractors (dict): Name to function f(line, next_line) that returns the value or None if the line does not
+                           match. next_line is the line following in the file, which is empty for the last line.
+        block_size (int): Number of bytes read at once. Default is 65536.
+        max_bytes (int): Stop after reading this number of bytes from the end. Default is None, the whole file.
+
+    Returns:
+        dict: Name to value of the last matching line in the file, None if not found.
+    """
+    values = {x: None for x in extractors}
+    remaining = dict(extractors)
+    lines = read_tail_lines(filepath, block_size=block_size, max_bytes=max_bytes)
+    next_line = ""
+    try:
+        for line in lines:
+            for key, extractor in list(remaining.items()):
+                value = extractor(line, next_line)
+                if value is not None:
+                    values[key] = value
+                    del remaining[key]
+            if len(remaining) == 0:
+                break
+            next_line = line
+    finally:
+        lines.close()
+    return values
+
+
+def make_token_extractor(key, index=-2):
+    """
+    Make an extractor for find_in_tail() that reads a number from lines containing key.
+
+    Args:
+        key (str): Substring of the line.
+        index (int): Index of the whitespace separated token to convert to float. Default is -2.
+
+    Returns:
+        function: Extractor f(line, next_line).
+    """
+    def extractor(line, next_line):
+        if key not in line:
+            return None
+        return float(line.split()[index].replace("D", "E"))
+    return extractor
+
+
+def make_regex_extractor(pattern, convert=float):
+    """
+    Make an extractor for find_in_tail() that converts the first group of a regular expression.
+
+    Args:
+        pattern (re.Pattern): Compiled regular expression with one group.
+        convert (function): Conversion of the matched string. Default is float.
+
+    Returns:
+        function: Extractor f(line, next_line).
+    """
+    def extractor(line, next_line):
+        match = pattern.search(line)
+        if match is None:
+            return None
+        return convert(match.group(1))
+    return extractor
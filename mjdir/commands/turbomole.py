@@ -1,4 +1,7 @@
 import os
+import re
+
+from mjdir.commands.reader import find_in_tail, make_token_extractor, make_regex_extractor
 
 # import ase
 
@@ -83,6 +86,43 @@ def read_turbomole_output(filepath, calc):
         return calc
 
 
+TURBOMOLE_TIME_UNITS = re.compile(r"([\d.]+)\s*(days?|hours?|minutes?|seconds?)")
+TURBOMOLE_TIME_SECONDS = {"day": 86400, "hour": 3600, "minute": 60, "second": 1}
+
+
+def _read_turbomole_wall_time(line, next_line):
+    """Wall time in seconds from e.g. 'total wall-time :   1 minutes and  4 seconds'."""
+    if "total wall-time" not in line:
+        return None
+    units = TURBOMOLE_TIME_UNITS.findall(line)
+    if len(units) == 0:
+        return None
+    return sum(float(x) * TURBOMOLE_TIME_SECONDS[unit.rstrip("s")] for x, unit in units)
+
+
+def _read_turbomole_converged(line, next_line):
+    """Whether the module ended normally, False if it ended abnormally or did not converge."""
+    if "ended abnormally" in line or "did not converge" in line:
+        return False
+    if "ended normally" in line:
+        return True
+    return None
+
+
+TURBOMOLE_EIGER_EXTRACTORS = {'homo': make_token_extractor('HOMO:'),
+                              'lumo': make_token_extractor('LUMO:'),
+                              'total_energy': make_token_extractor('Total energy')
+                              }
+
+TURBOMOLE_OUTPUT_EXTRACTORS = {
+    'total_energy': make_regex_extractor(re.compile(r"\|\s*total energy\s*=\s*(\S+)")),
+    'gradient_norm': make_regex_extractor(re.compile(r"norm of actual CARTESIAN gradient:\s*(\S+)"),
+                                          convert=lambda x: float(x.replace("D", "E"))),
+    'converged': _read_turbomole_converged,
+    'wall_time': _read_turbomole_wall_time
+}
+
+
 def read_turbomole_eiger_file(path):
     """
     Read the ouput of eiger files.
@@ -93,19 +133,38 @@ def read_turbomole_eiger_file(path):
     Returns:
         tuple: homo,lumo,toteng.
 
+    Raises:
+        ValueError: If HOMO, LUMO or total energy is not found in the file.
+
+    """
+    filepath = os.path.join(path, "atomic.levels.dat")
+    values = find_in_tail(filepath, TURBOMOLE_EIGER_EXTRACTORS)
+    if any(x is None for x in values.values()):
+        raise ValueError("No HOMO/LUMO/total energy found in %s" % filepath)
+    return values['homo'], values['lumo'], values['total_energy']
+
+
+def read_turbomole_log(path, quantities=None, filename="ridft.out", max_bytes=None):
+    """
+    Read quantities from the end of a turbomole output like ridft.out or job.last in a single backward pass,
+    see find_in_tail(). Reading stops as soon as all quantities are found.
+
+    Args:
+        path (str,path): File path to destination folder.
+        quantities (list): Names of TURBOMOLE_OUTPUT_EXTRACTORS, i.e. 'total_energy', 'gradient_norm',
+                           'converged' and 'wall_time' (in s). Default is None, all.
+        filename (str): Name of the output file. Default is "ridft.out".
+        max_bytes (int): Only search this number of bytes from the end. Default is None, the whole file.
+
+    Returns:
+        dict: Quantity to value, None if not found.
+
     """
-    homo = None
-    lumo = None
-    toteng = None
-    with open(os.path.join(path, "atomic.levels.dat"), "r") as f:
-        for line in f.readlines():
-            if line.find('HOMO:') > 0:
-                line_list = line.split(' ')
-                homo = line_list[-2]
-            if line.find('LUMO:') > 0:
-                line_list = line.split(' ')
-                lumo = line_list[-2]
-            if line.find('Total energy') >= 0:
-                line_list = line.split(' ')
-                toteng = line_list[-2]
-    return float(homo), float(lumo), float(toteng)
+    if quantities is None:
+        quantities = list(TURBOMOLE_OUTPUT_EXTRACTORS.keys())
+    unknown = [x for x in quantities if x not in TURBOMOLE_OUTPUT_EXTRACTORS]
+    if len(unknown) > 0:
+        raise ValueError("Unknown quantities %s, available are %s" % (unknown,
+                                                                      list(TURBOMOLE_OUTPUT_EXTRACTORS.keys())))
+    return find_in_tail(os.path.join(path, filename), {x: TURBOMOLE_OUTPUT_EXTRACTORS[x] for x in quantities},
+                        max_bytes=max_bytes)
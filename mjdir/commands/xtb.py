@@ -1,4 +1,8 @@
 import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from mjdir.commands.reader import find_in_tail, make_token_extractor, make_regex_extractor
 
 XTB_HOMEPATH_TARBALL_DIRECTORY = '"~/xtb_6.2.3"'
 
@@ -31,6 +35,63 @@ XTB_SLURM_COMMANDS = {'singlepoint': 'cd {path} && xtb --scc {input} > output.tx
                       }
 
 
+XTB_WALL_TIME = re.compile(r"wall-time:\s+(\d+) d,\s+(\d+) h,\s+(\d+) min,\s+([\d.]+) sec")
+
+
+def _read_xtb_wall_time(line, next_line):
+    """Total wall time in seconds from the timings, which are given for 'total:' first and then per step."""
+    if line.strip() != "total:":
+        return None
+    match = XTB_WALL_TIME.search(next_line)
+    if match is None:
+        return None
+    days, hours, minutes, seconds = match.groups()
+    return 86400 * int(days) + 3600 * int(hours) + 60 * int(minutes) + float(seconds)
+
+
+def _read_xtb_converged(line, next_line):
+    """Whether xtb terminated normally, False for abnormal termination or failed optimization."""
+    if "abnormal termination of xtb" in line or "FAILED TO CONVERGE" in line:
+        return False
+    if "normal termination of xtb" in line:
+        return True
+    return None
+
+
+XTB_OUTPUT_EXTRACTORS = {'homo': make_token_extractor('(HOMO)'),
+                         'lumo': make_token_extractor('(LUMO)'),
+                         'total_energy': make_regex_extractor(re.compile(r"total energy\s+(\S+)\s+Eh", re.I)),
+                         'gradient_norm': make_regex_extractor(re.compile(r"gradient norm\s+(\S+)\s+Eh", re.I)),
+                         'converged': _read_xtb_converged,
+                         'wall_time': _read_xtb_wall_time
+                         }
+
+
+def read_xtb_output(path, quantities=None, filename="output.txt", max_bytes=None):
+    """
+    Read quantities from the end of the xtb output in a single backward pass, see find_in_tail().
+    Reading stops as soon as all quantities are found.
+
+    Args:
+        path (str): Filepath to destination folder.
+        quantities (list): Names of XTB_OUTPUT_EXTRACTORS, i.e. 'homo', 'lumo' (in eV), 'total_energy',
+                           'gradient_norm' (in Eh), 'converged' and 'wall_time' (in s). Default is None, all.
+        filename (str): Name of the output file. Default is "output.txt".
+        max_bytes (int): Only search this number of bytes from the end. Default is None, the whole file.
+
+    Returns:
+        dict: Quantity to value, None if not found.
+
+    """
+    if quantities is None:
+        quantities = list(XTB_OUTPUT_EXTRACTORS.keys())
+    unknown = [x for x in quantities if x not in XTB_OUTPUT_EXTRACTORS]
+    if len(unknown) > 0:
+        raise ValueError("Unknown quantities %s, available are %s" % (unknown, list(XTB_OUTPUT_EXTRACTORS.keys())))
+    return find_in_tail(os.path.join(path, filename), {x: XTB_OUTPUT_EXTRACTORS[x] for x in quantities},
+                        max_bytes=max_bytes)
+
+
 def read_homo_lumo(path):
     """
     Read hom lumo from output
@@ -41,20 +102,14 @@ def read_homo_lumo(path):
     Returns:
         tuple: homo,lumo
 
+    Raises:
+        ValueError: If HOMO or LUMO is not found in the output.
+
     """
-    homo = None
-    lumo = None
-    with open(os.path.join(path, "output.txt"), "r") as f:
-        for line in f.readlines():
-            if line.find('(HOMO)') > 0:
-                line_list = line.strip().split(' ')
-                line_list = [x for x in line_list if x != '']
-                homo = line_list[-2]
-            if line.find('(LUMO)') > 0:
-                line_list = line.strip().split(' ')
-                line_list = [x for x in line_list if x != '']
-                lumo = line_list[-2]
-    return float(homo), float(lumo)
+    values = read_xtb_output(path, ['homo', 'lumo'])
+    if values['homo'] is None or values['lumo'] is None:
+        raise ValueError("No HOMO/LUMO found in %s" % os.path.join(path, "output.txt"))
+    return values['homo'], values['lumo']
 
 
 # xtb can have xyz input file
@@ -93,6 +148,7 @@ def write_turbomole(filename, atoms):
         filename (str): Filepath of filename.
         atoms (TYPE): Atoms
     """
+    import numpy as np
     from ase.constraints import FixAtoms
     from ase.units import Bohr
 
@@ -108,17 +164,13 @@ def write_turbomole(filename, atoms):
     if atoms.constraints:
         for constr in atoms.constraints:
             if isinstance(constr, FixAtoms):
-                fix_index = constr.index
+                # index holds atom indices, or a boolean mask in older ase versions
+                fixed = np.zeros(len(atoms), dtype=bool)
+                fixed[constr.index] = True
                 printfixed = True
-    # print sflags
 
     if printfixed:
-        fix_str = []
-        for i in fix_index:
-            if i == 1:
-                fix_str.append("f")
-            else:
-                fix_str.append(" ")
+        fix_str = ["f" if x else " " for x in fixed]
 
     f.write("$coord\n")
     if printfixed:
@@ -131,3 +183,104 @@ def write_turbomole(filename, atoms):
             f.write('%20.14f  %20.14f  %20.14f      %2s \n'
                     % (x / Bohr, y / Bohr, z / Bohr, s.lower()))
     f.write("$end\n")
+
+
+def _get_molecule(coords, elements, num_atoms, i):
+    """Coordinates as array and elements as list of molecule i of a 3D array or a ragged list of molecules.
+    Elements can be given once for all molecules."""
+    import numpy as np
+    xyz = np.asarray(coords[i], dtype=float)
+    symbols = list(elements if isinstance(elements[0], str) else elements[i])
+    if num_atoms is not None:
+        xyz = xyz[:num_atoms[i]]
+        symbols = symbols[:num_atoms[i]]
+    return xyz, symbols
+
+
+def _format_atoms(line_format, columns):
+    """Format all atoms of a molecule by a single % operation on the repeated line format."""
+    num_atoms = len(columns[0])
+    arguments = [None] * (num_atoms * len(columns))
+    for i, x in enumerate(columns):
+        arguments[i::len(columns)] = x.tolist() if hasattr(x, "tolist") else x
+    return (line_format * num_atoms) % tuple(arguments)
+
+
+def _write_files(filenames, make_text, workers=8, chunksize=256):
+    """Write make_text(i) to filenames[i] in chunks of files by a thread pool."""
+    def write_chunk(start):
+        for i in range(start, min(start + chunksize, len(filenames))):
+            with open(filenames[i], "w") as f:
+                f.write(make_text(i))
+
+    starts = range(0, len(filenames), chunksize)
+    if workers <= 1:
+        for x in starts:
+            write_chunk(x)
+        return
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(write_chunk, starts))
+
+
+def export_xyz_batch(filenames, coords, elements, masks=None, num_atoms=None, workers=8):
+    """
+    Export XYZ files of many molecules, identical to export_xyz() per molecule.
+
+    Args:
+        filenames (list): Filepaths of target files, e.g. os.path.join(path, "input.xyz") of each job.
+        coords (np.ndarray,list): Coordinates of shape (n_molecules, n_atoms, 3) or list of (n_atoms, 3) arrays.
+        elements (list): Elements of shape (n_molecules, n_atoms), or a list of elements for all molecules.
+        masks (list): Mask of atom indices per molecule. Defaults to None, all atoms.
+        num_atoms (list): Number of atoms per molecule of padded coordinates. Defaults to None, all atoms.
+        workers (int): Number of threads to write files. Defaults to 8.
+
+    Returns:
+        None.
+
+    """
+    import numpy as np
+
+    def make_text(i):
+        xyz, symbols = _get_molecule(coords, elements, num_atoms, i)
+        mask = masks[i] if masks is not None else []
+        if len(mask) > 0:
+            xyz = xyz[np.asarray(mask, dtype=int)]
+            symbols = [symbols[x] for x in mask]
+        symbols = [x.capitalize() for x in symbols]
+        return "%i\n\n" % len(symbols) + _format_atoms("%s %f %f %f\n", [symbols, xyz[:, 0], xyz[:, 1], xyz[:, 2]])
+
+    _write_files(filenames, make_text, workers=workers)
+
+
+def write_turbomole_batch(filenames, coords, elements, fixed=None, num_atoms=None, workers=8):
+    """
+    Write turbomole coord files of many molecules, identical to write_turbomole() per molecule.
+
+    Args:
+        filenames (list): Filepaths of target files, e.g. os.path.join(path, "coord") of each job.
+        coords (np.ndarray,list): Coordinates in Angstrom of shape (n_molecules, n_atoms, 3) or list of (n_atoms, 3)
+                                  arrays.
+        elements (list): Chemical symbols of shape (n_molecules, n_atoms), or a list of symbols for all molecules.
+        fixed (list): Boolean flags of fixed atoms per molecule, like a FixAtoms constraint in write_turbomole().
+                      Defaults to None, no constraints.
+        num_atoms (list): Number of atoms per molecule of padded coordinates. Defaults to None, all atoms.
+        workers (int): Number of threads to write files. Defaults to 8.
+
+    Returns:
+        None.
+
+    """
+    from ase.units import Bohr
+
+    def make_text(i):
+        xyz, symbols = _get_molecule(coords, elements, num_atoms, i)
+        xyz = xyz / Bohr
+        columns = [xyz[:, 0], xyz[:, 1], xyz[:, 2], [x.lower() for x in symbols]]
+        if fixed is not None and fixed[i] is not None:
+            columns.append(["f" if x else " " for x in fixed[i][:len(symbols)]])
+            atoms = _format_atoms('%20.14f  %20.14f  %20.14f      %2s  %2s \n', columns)
+        else:
+            atoms = _format_atoms('%20.14f  %20.14f  %20.14f      %2s \n', columns)
+        return "$coord\n" + atoms + "$end\n"
+
+    _write_files(filenames, make_text, workers=workers)
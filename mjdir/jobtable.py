@@ -0,0 +1,163 @@
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
+_MISSING = object()
+
+
+class JobRecord(MutableMapping):
+    """Dict-like view on the fields of a single job in a JobTable."""
+
+    __slots__ = ("_table", "_name")
+
+    def __init__(self, table, name):
+        self._table = table
+        self._name = name
+
+    def __getitem__(self, key):
+        return self._table._get_field(self._name, key)
+
+    def __setitem__(self, key, value):
+        self._table._set_field(self._table._index[self._name], key, value)
+
+    def __delitem__(self, key):
+        self._table._del_field(self._name, key)
+
+    def __iter__(self):
+        return iter(self._table._get_keys(self._name))
+
+    def __len__(self):
+        return len(self._table._get_keys(self._name))
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+class JobTable(MutableMapping):
+    """Compact column store for the job information of very many jobs.
+
+    Each field like 'command' or 'input' is a column list, string values are shared between jobs and the 'path'
+    is derived from the job name on access. Items are returned as lazy dict-like JobRecord views.
+    """
+
+    def __init__(self, path_function=None):
+        """Initialize empty table.
+
+        Args:
+            path_function (callable): Function that returns the default path for a job name. Only paths that
+                                      differ from the default are stored. Default is None.
+        """
+        self._path_function = path_function
+        self._names = []
+        self._index = {}
+        self._columns = {}
+        self._paths = {}
+        self._strings = {}
+        self._num_deleted = 0
+
+    @classmethod
+    def from_dict(cls, jobinfo, path_function=None):
+        """Make a table from a dict of job names to dicts of fields."""
+        table = cls(path_function)
+        for key, value in jobinfo.items():
+            table[key] = value
+        return table
+
+    def _intern(self, value):
+        if isinstance(value, str):
+            return self._strings.setdefault(value, value)
+        return value
+
+    def _get_field(self, name, key):
+        row = self._index[name]
+        if key == "path" and self._path_function is not None:
+            if name in self._paths:
+                return self._paths[name]
+            return self._path_function(name)
+        column = self._columns.get(key)
+        if column is None or column[row] is _MISSING:
+            raise KeyError(key)
+        return column[row]
+
+    def _set_field(self, row, key, value):
+        if key == "path" and self._path_function is not None:
+            name = self._names[row]
+            if value == self._path_function(name):
+                self._paths.pop(name, None)
+            else:
+                self._paths[name] = value
+            return
+        column = self._columns.get(key)
+        if column is None:
+            column = [_MISSING] * len(self._names)
+            self._columns[key] = column
+        column[row] = self._intern(value)
+
+    def _del_field(self, name, key):
+        if key == "path" and self._path_function is not None:
+            raise KeyError("Path of job can not be deleted.")
+        column = self._columns.get(key)
+        row = self._index[name]
+        if column is None or column[row] is _MISSING:
+            raise KeyError(key)
+        column[row] = _MISSING
+
+    def _get_keys(self, name):
+        row = self._index[name]
+        keys = ["path"] if self._path_function is not None else []
+        keys += [key for key, column in self._columns.items() if column[row] is not _MISSING]
+        return keys
+
+    def _compact(self):
+        rows = [i for i, x in enumerate(self._names) if x is not None]
+        self._names = [self._names[i] for i in rows]
+        self._index = {x: i for i, x in enumerate(self._names)}
+        for key in list(self._columns.keys()):
+            self._columns[key] = [self._columns[key][i] for i in rows]
+        self._num_deleted = 0
+
+    def __getitem__(self, name):
+        if name not in self._index:
+            raise KeyError(name)
+        return JobRecord(self, name)
+
+    def __setitem__(self, name, value):
+        if isinstance(value, JobRecord):
+            value = dict(value.items())
+        if name in self._index:
+            row = self._index[name]
+            for column in self._columns.values():
+                column[row] = _MISSING
+            self._paths.pop(name, None)
+        else:
+            row = len(self._names)
+            self._names.append(name)
+            self._index[name] = row
+            for column in self._columns.values():
+                column.append(_MISSING)
+        for key, x in value.items():
+            self._set_field(row, key, x)
+
+    def __delitem__(self, name):
+        row = self._index.pop(name)
+        self._names[row] = None
+        for column in self._columns.values():
+            column[row] = _MISSING
+        self._paths.pop(name, None)
+        self._num_deleted += 1
+        if self._num_deleted > len(self._index):
+            self._compact()
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def __iter__(self):
+        return (x for x in self._names if x is not None)
+
+    def __len__(self):
+        return len(self._index)
+
+    def to_dict(self):
+        """Return job information as dict of dicts."""
+        return {x: dict(JobRecord(self, x).items()) for x in self}
@@ -1,5 +1,10 @@
+import asyncio
+import json
 import os
+import re
+import shlex
 import subprocess
+import time
 
 SLURM_DEFUALT_PROPS = {
     'time': "1:00:00",
@@ -7,81 +12,956 @@ SLURM_DEFUALT_PROPS = {
     'tasks': "1"
 }
 
+SLURM_TRANSIENT_ERRORS = (
+    "Socket timed out",
+    "temporarily unavailable",
+    "Unable to contact slurm controller",
+    "Transport endpoint is not connected",
+    "try again"
+)
+
+# Errors of sbatch for submit limits. The generic "Job violates accounting/QOS policy" is not included, since it
+# is also raised for permanent errors like a wrong account, only its variant for submit limits.
+SLURM_LIMIT_ERRORS = (
+    "MaxSubmitJob",
+    "MaxJobs",
+    "QOSMaxSubmitJobPerUserLimit",
+    "AssocMaxSubmitJobLimit",
+    "job submit limit"
+)
+
+
+def _write_slurm_header(rsh, slurm_name, slurmout, slurm_variables, header, extra_variables={}):
+    """Write shebang, #SBATCH options and user header to an open bash script."""
+    bash_variables = {}
+    bash_variables.update(SLURM_DEFUALT_PROPS)
+    bash_variables.update(slurm_variables)
+    bash_variables.update(extra_variables)
+
+    rsh.write('#! /bin/bash\n')
+    rsh.write('#SBATCH --job-name=%s\n' % slurm_name)
+    rsh.write('#SBATCH --output=%s\n' % slurmout)
+
+    for keys, values in bash_variables.items():
+        rsh.write('#SBATCH --{key}={value}\n'.format(key=keys, value=values))
+
+    rsh.write('\n')
+    rsh.write(header)
+    rsh.write('\n')
+
+
+def _write_task_function(rsh, dirmain, slurm_name, exitcodes=False, telemetry=False, markers=False,
+                         exit_failed=False):
+    """Write bash function mjdir_task <job> <command> that runs a command in a subshell.
+
+    With exitcodes=True the exit code of each job is appended to <script>.exitcodes in dirmain.
+    With telemetry=True a JSON line with job, script, slurm ids, node, start, end and exit status is appended to
+    <script>.jsonl in dirmain. The command runs in a subshell of the script like without telemetry and maxrss_kb
+    is null. With telemetry='maxrss' the max RSS is also recorded if /usr/bin/time exists. Then the command runs
+    via bash -c, so that only exported variables of the header are available and functions must be exported.
+    With markers=True the state of each job, i.e. running, done or failed with exit code and time, is appended
+    to <script>.state in dirmain, see read_slurm_states().
+    With exit_failed=True failed jobs are recorded to a temporary file, see _write_failed_exit().
+    """
+    script_base = os.path.join(dirmain, os.path.splitext(slurm_name)[0])
+    if exitcodes:
+        rsh.write('EXITLOG="%s"\n' % (script_base + ".exitcodes"))
+    if telemetry:
+        rsh.write('TELEMETRYLOG="%s"\n' % (script_base + ".jsonl"))
+    if markers:
+        rsh.write('STATELOG="%s"\n' % (script_base + ".state"))
+    if exit_failed:
+        rsh.write('FAILLOG=$(mktemp)\n')
+    rsh.write('mjdir_task() {\n')
+    rsh.write('    local rc\n')
+    if markers:
+        rsh.write('    echo "$1 running - $(date +%s.%N)" >> "$STATELOG"\n')
+    if telemetry:
+        rsh.write('    local start rss=null\n')
+        rsh.write('    start=$(date +%s.%N)\n')
+    if telemetry == "maxrss":
+        rsh.write('    if [ -x /usr/bin/time ]; then\n')
+        rsh.write('        local tmp\n')
+        rsh.write('        tmp=$(mktemp)\n')
+        rsh.write('        /usr/bin/time -f "%M" -o "$tmp" bash -c "$2"\n')
+        rsh.write('        rc=$?\n')
+        rsh.write('        rss=$(tail -n 1 "$tmp")\n')
+        rsh.write('        rm -f "$tmp"\n')
+        rsh.write('        case $rss in \'\'|*[!0-9]*) rss=null ;; esac\n')
+        rsh.write('    else\n')
+        rsh.write('        ( eval "$2" )\n')
+        rsh.write('        rc=$?\n')
+        rsh.write('    fi\n')
+    else:
+        rsh.write('    ( eval "$2" )\n')
+        rsh.write('    rc=$?\n')
+    if exitcodes:
+        rsh.write('    echo "$1 $rc" >> "$EXITLOG"\n')
+    if exit_failed:
+        rsh.write('    [ $rc -eq 0 ] || echo "$1" >> "$FAILLOG"\n')
+    if markers:
+        rsh.write('    if [ $rc -eq 0 ]; then\n')
+        rsh.write('        echo "$1 done $rc $(date +%s.%N)" >> "$STATELOG"\n')
+        rsh.write('    else\n')
+        rsh.write('        echo "$1 failed $rc $(date +%s.%N)" >> "$STATELOG"\n')
+        rsh.write('    fi\n')
+    if telemetry:
+        rsh.write('    printf \'{"job": "%%s", "script": "%%s", "job_id": "%%s", "array_task": "%%s", "node": "%%s", '
+                  '"start": %%s, "end": %%s, "exit": %%s, "maxrss_kb": %%s}\\n\' '
+                  '"$1" "%s" "${SLURM_ARRAY_JOB_ID:-$SLURM_JOB_ID}" "$SLURM_ARRAY_TASK_ID" '
+                  '"${SLURMD_NODENAME:-$HOSTNAME}" "$start" "$(date +%%s.%%N)" "$rc" "$rss" >> "$TELEMETRYLOG"\n'
+                  % slurm_name)
+    rsh.write('    return $rc\n')
+    rsh.write('}\n')
+
+
+def _write_failed_exit(rsh):
+    """Write the end of a script that exits with 1 if any job of mjdir_task failed, so that dependencies like
+    afterok or aftercorr do not start. Requires _write_task_function() with exit_failed=True."""
+    rsh.write('wait\n')
+    rsh.write('if [ -s "$FAILLOG" ]; then\n')
+    rsh.write('    echo "Error: $(wc -l < "$FAILLOG") jobs failed"\n')
+    rsh.write('    rm -f "$FAILLOG"\n')
+    rsh.write('    exit 1\n')
+    rsh.write('fi\n')
+    rsh.write('rm -f "$FAILLOG"\n')
+
+
+def _write_slurm_commands(rsh, asyn, name_list, pathlist, commands, pool=False, wrap=False):
+    """Write formatted commands for a list of jobs to an open bash script.
+
+    With pool=True and asyn > 0, a rolling pool keeps asyn commands running at all times
+    instead of waiting for each block of asyn commands. With wrap=True or pool=True the commands
+    are run by mjdir_task, which requires _write_task_function().
+    """
+    if pool and asyn > 0:
+        for i, path in enumerate(pathlist):
+            rsh.write('while [ "$(jobs -rp | wc -l)" -ge %i ]; do wait -n; done\n' % asyn)
+            rsh.write('mjdir_task %s %s &\n' % (shlex.quote(name_list[i]), shlex.quote(commands[i].format(**path))))
+            rsh.write('echo "Info: {job} submitted at {path}"\n'.format(path=path, job=name_list[i]))
+        rsh.write('wait\n')
+        return
+    for i, path in enumerate(pathlist):
+        if wrap:
+            rsh.write('mjdir_task %s %s' % (shlex.quote(name_list[i]), shlex.quote(commands[i].format(**path))))
+        else:
+            rsh.write(commands[i].format(**path))
+        if asyn > 0:
+            rsh.write(' &\n')
+        else:
+            rsh.write('\n')
+        rsh.write('echo "Info: {job} submitted at {path}"\n'.format(path=path, job=name_list[i]))
+        if asyn > 0 and (i + 1) % asyn == 0:
+            rsh.write('wait\n')
+
+
+def _encode_manifest(name_list, pathlist, commands):
+    """Return NUL-terminated job names and formatted commands as bytes."""
+    data = "".join("%s\0%s\0" % (name_list[i], commands[i].format(**path)) for i, path in enumerate(pathlist))
+    return data.encode("utf8")
+
+
+def make_slurm_manifest(manifestpath, name_list=[], pathlist=[], commands=[]):
+    """Write job names and formatted commands to a manifest file in a single write.
+
+    Each job is stored as name and command, both terminated by a NUL byte, so that commands may contain any
+    character but NUL. Read by the loop of _write_manifest_loop().
+
+    Args:
+        manifestpath (str): Path of the manifest file.
+        name_list (list): List of job names.
+        pathlist (list): List of format arguments for each command.
+        commands (list): List of commands.
+
+    Returns:
+        int: Size of the manifest in bytes.
+    """
+    data = _encode_manifest(name_list, pathlist, commands)
+    with open(manifestpath, 'wb') as f:
+        f.write(data)
+    return len(data)
+
+
+def _write_manifest_loop(rsh, asyn, source, pool=False, wrap=False):
+    """Write a loop that runs all jobs of a manifest to an open bash script.
+
+    The manifest is read on file descriptor 3 from source, e.g. '"$MANIFEST"' or a process substitution, so that
+    commands can not consume it via stdin. Options are the same as for _write_slurm_commands().
+    """
+    run_cmd = 'mjdir_task "$name" "$cmd"' if wrap or (pool and asyn > 0) else '( eval "$cmd" )'
+    rsh.write('i=0\n')
+    rsh.write("while IFS= read -r -d '' -u 3 name && IFS= read -r -d '' -u 3 cmd; do\n")
+    if pool and asyn > 0:
+        rsh.write('    while [ "$(jobs -rp | wc -l)" -ge %i ]; do wait -n; done\n' % asyn)
+    rsh.write('    %s%s\n' % (run_cmd, ' &' if asyn > 0 else ''))
+    rsh.write('    echo "Info: $name submitted"\n')
+    if asyn > 0 and not pool:
+        rsh.write('    i=$((i + 1))\n')
+        rsh.write('    if [ $((i %% %i)) -eq 0 ]; then wait; fi\n' % asyn)
+    rsh.write('done 3< %s\n' % source)
+    if asyn > 0:
+        rsh.write('wait\n')
+
 
 def make_slurm_script(dirmain, slurm_name, asyn=0,
                       name_list=[],
                       pathlist=[],
                       commands=[],
                       header="\n",
-                      slurm_variables=SLURM_DEFUALT_PROPS):
-    """Make bash script for unix for name,path and command list"""
+                      slurm_variables=SLURM_DEFUALT_PROPS,
+                      pool=False,
+                      telemetry=False,
+                      markers=False,
+                      manifest=False,
+                      exit_failed=False):
+    """Make bash script for unix for name,path and command list.
+
+    With pool=True and asyn > 0 the script keeps asyn commands running at all times (rolling pool via wait -n,
+    requires bash >= 4.3) and records the exit code of each job to <script>.exitcodes in dirmain.
+    With telemetry=True each job appends a JSON record to <script>.jsonl in dirmain, see read_slurm_telemetry().
+    Use telemetry='maxrss' to also record the max RSS, see _write_task_function().
+    With markers=True each job appends its state to <script>.state in dirmain, see read_slurm_states().
+    With manifest=True the jobs are written to <script>.manifest in dirmain and the script only contains a loop
+    over the manifest, so that its size does not depend on the number of jobs.
+    With exit_failed=True the script exits with 1 if any job failed, e.g. for --dependency=afterok.
+    """
 
     scriptpath = os.path.join(dirmain, slurm_name)
     slurmout = os.path.join(dirmain, "slurm_%j.output")
-    bash_variables = {}
-    bash_variables.update(SLURM_DEFUALT_PROPS)
-    bash_variables.update(slurm_variables)
 
     with open(scriptpath, 'w') as rsh:
-        rsh.write('#! /bin/bash\n')
-        rsh.write('#SBATCH --job-name=%s\n' % slurm_name)
-        rsh.write('#SBATCH --output=%s\n' % slurmout)
+        _write_slurm_header(rsh, slurm_name, slurmout, slurm_variables, header)
+        wrap = telemetry or markers or exit_failed
+        if (pool and asyn > 0) or wrap:
+            _write_task_function(rsh, dirmain, slurm_name, exitcodes=pool and asyn > 0, telemetry=telemetry,
+                                 markers=markers, exit_failed=exit_failed)
+        if manifest:
+            manifestpath = os.path.splitext(scriptpath)[0] + ".manifest"
+            make_slurm_manifest(manifestpath, name_list, pathlist, commands)
+            rsh.write('MANIFEST="%s"\n' % manifestpath)
+            _write_manifest_loop(rsh, asyn, '"$MANIFEST"', pool=pool, wrap=wrap)
+        else:
+            _write_slurm_commands(rsh, asyn, name_list, pathlist, commands, pool=pool, wrap=wrap)
+        if exit_failed:
+            _write_failed_exit(rsh)
 
-        for keys, values in bash_variables.items():
-            rsh.write('#SBATCH --{key}={value}\n'.format(key=keys, value=values))
 
-        rsh.write('\n')
-        rsh.write(header)
-        rsh.write('\n')
-        for i, path in enumerate(pathlist):
-            rsh.write(commands[i].format(**path))
-            if asyn > 0:
-                rsh.write(' &\n')
-            else:
-                rsh.write('\n')
-            rsh.write('echo "Info: {job} submitted at {path}"\n'.format(path=path, job=name_list[i]))
-            if asyn > 0 and (i + 1) % asyn == 0:
-                rsh.write('wait\n')
+def make_slurm_array_script(dirmain, slurm_name, asyn=0,
+                            name_list=[],
+                            pathlist=[],
+                            commands=[],
+                            header="\n",
+                            slurm_variables=SLURM_DEFUALT_PROPS,
+                            array_limit=0,
+                            pool=False,
+                            telemetry=False,
+                            markers=False,
+                            manifest=False,
+                            exit_failed=False):
+    """Make a single bash script for a slurm job array.
 
+    Each array task dispatches on $SLURM_ARRAY_TASK_ID to its own slice of jobs.
+    Note that the number of tasks is limited by the MaxArraySize of the cluster.
 
-def make_slurm_sub(dirmain, slurm_submit, bash_submit={}):
-    """ make submission command for slurm via sbatch"""
+    Args:
+        dirmain (str): Main directory to write the script to.
+        slurm_name (str): Name of the bash script.
+        asyn (int): Number of asynchronous commands within one array task.
+        name_list (list): List of job name lists, one list per array task.
+        pathlist (list): List of format argument lists, one list per array task.
+        commands (list): List of command lists, one list per array task.
+        header (str): Header for queueing system that is written to bash script.
+        slurm_variables (dict): Slurm parameters for the script.
+        array_limit (int): Maximum number of simultaneously running tasks (%M). Default is 0, no limit.
+        pool (bool): Whether to run asyn commands as rolling pool, see make_slurm_script(). Default is False.
+        telemetry (bool): Whether to record telemetry of each job, see make_slurm_script(). Default is False.
+        markers (bool): Whether to record the state of each job, see make_slurm_script(). Default is False.
+        manifest (bool): Whether to write the jobs of all tasks to <script>.manifest in dirmain instead of the
+                         script. The byte offset and size of each task in the manifest are written as one line per
+                         task to <script>.manifest.index. Default is False.
+        exit_failed (bool): Whether an array task exits with 1 if any of its jobs failed, e.g. for
+                            --dependency=aftercorr. Default is False.
+    """
+    scriptpath = os.path.join(dirmain, slurm_name)
+    slurmout = os.path.join(dirmain, "slurm_%A_%a.output")
+    array_range = "0-%i" % (len(name_list) - 1)
+    if array_limit > 0:
+        array_range += "%%%i" % array_limit
+
+    with open(scriptpath, 'w') as rsh:
+        _write_slurm_header(rsh, slurm_name, slurmout, slurm_variables, header,
+                            extra_variables={'array': array_range})
+        wrap = telemetry or markers or exit_failed
+        if (pool and asyn > 0) or wrap:
+            _write_task_function(rsh, dirmain, slurm_name, exitcodes=pool and asyn > 0, telemetry=telemetry,
+                                 markers=markers, exit_failed=exit_failed)
+        if manifest:
+            manifestpath = os.path.splitext(scriptpath)[0] + ".manifest"
+            data = []
+            index = []
+            offset = 0
+            for i in range(len(name_list)):
+                chunk = _encode_manifest(name_list[i], pathlist[i], commands[i])
+                data.append(chunk)
+                index.append("%i %i\n" % (offset, len(chunk)))
+                offset += len(chunk)
+            with open(manifestpath, 'wb') as f:
+                f.write(b"".join(data))
+            with open(manifestpath + ".index", 'w') as f:
+                f.write("".join(index))
+            rsh.write('MANIFEST="%s"\n' % manifestpath)
+            rsh.write('read -r OFFSET SIZE < <(sed -n "$((SLURM_ARRAY_TASK_ID + 1))p" "$MANIFEST.index")\n')
+            _write_manifest_loop(rsh, asyn, '<(tail -c +$((OFFSET + 1)) "$MANIFEST" | head -c "$SIZE")',
+                                 pool=pool, wrap=wrap)
+        else:
+            rsh.write('case $SLURM_ARRAY_TASK_ID in\n')
+            for i in range(len(name_list)):
+                rsh.write('%i)\n' % i)
+                _write_slurm_commands(rsh, asyn, name_list[i], pathlist[i], commands[i], pool=pool, wrap=wrap)
+                rsh.write(';;\n')
+            rsh.write('esac\n')
+        if exit_failed:
+            _write_failed_exit(rsh)
+
+
+def make_task_queue(queuedir, name_list=[], pathlist=[], commands=[]):
+    """Make an on-disk task queue for worker scripts.
+
+    Each job is written as a small bash file to queuedir/pending. Workers claim a task by
+    atomically renaming it to queuedir/running and move it to queuedir/done or queuedir/failed.
+
+    Args:
+        queuedir (str): Directory of the task queue.
+        name_list (list): List of job names.
+        pathlist (list): List of format arguments for each command.
+        commands (list): List of commands.
+
+    Returns:
+        list: Task file names.
+    """
+    for x in ["pending", "running", "done", "failed"]:
+        if not os.path.exists(os.path.join(queuedir, x)):
+            os.makedirs(os.path.join(queuedir, x))
+    tasks = []
+    for i, path in enumerate(pathlist):
+        task = "%08i_%s" % (i, name_list[i])
+        with open(os.path.join(queuedir, "pending", task), 'w') as f:
+            f.write(commands[i].format(**path))
+            f.write('\n')
+        tasks.append(task)
+    return tasks
+
+
+def make_slurm_worker_script(dirmain, slurm_name, queuedir, asyn=0,
+                             header="\n",
+                             slurm_variables=SLURM_DEFUALT_PROPS,
+                             array_size=0,
+                             array_limit=0,
+                             telemetry=False,
+                             markers=False):
+    """Make bash script that runs worker loops on a task queue from make_task_queue().
+
+    The worker claims the next pending task until the queue is drained. The same script can be submitted
+    multiple times or as job array with array_size tasks.
+
+    Args:
+        dirmain (str): Main directory to write the script to.
+        slurm_name (str): Name of the bash script.
+        queuedir (str): Directory of the task queue.
+        asyn (int): Number of worker loops to run in parallel within one script. Default is 0, a single loop.
+        header (str): Header for queueing system that is written to bash script.
+        slurm_variables (dict): Slurm parameters for the script.
+        array_size (int): Number of array tasks. Default is 0, no job array.
+        array_limit (int): Maximum number of simultaneously running tasks (%M). Default is 0, no limit.
+        telemetry (bool): Whether to record telemetry of each job, see make_slurm_script(). Default is False.
+        markers (bool): Whether to record the state of each job, see make_slurm_script(). Default is False.
+    """
+    scriptpath = os.path.join(dirmain, slurm_name)
+    extra_variables = {}
+    if array_size > 0:
+        slurmout = os.path.join(dirmain, "slurm_%A_%a.output")
+        extra_variables['array'] = "0-%i" % (array_size - 1)
+        if array_limit > 0:
+            extra_variables['array'] += "%%%i" % array_limit
+    else:
+        slurmout = os.path.join(dirmain, "slurm_%j.output")
+
+    with open(scriptpath, 'w') as rsh:
+        _write_slurm_header(rsh, slurm_name, slurmout, slurm_variables, header,
+                            extra_variables=extra_variables)
+        if telemetry or markers:
+            _write_task_function(rsh, dirmain, slurm_name, telemetry=telemetry, markers=markers)
+        rsh.write('TASKDIR="%s"\n' % queuedir)
+        rsh.write('mjdir_worker() {\n')
+        rsh.write('    for task in "$TASKDIR"/pending/*; do\n')
+        rsh.write('        [ -e "$task" ] || continue\n')
+        rsh.write('        name="${task##*/}"\n')
+        rsh.write('        mv "$task" "$TASKDIR/running/$name" 2>/dev/null || continue\n')
+        if telemetry or markers:
+            rsh.write('        mjdir_task "${name#*_}" "$(< "$TASKDIR/running/$name")"\n')
+        else:
+            rsh.write('        ( . "$TASKDIR/running/$name" )\n')
+        rsh.write('        if [ $? -eq 0 ]; then\n')
+        rsh.write('            mv "$TASKDIR/running/$name" "$TASKDIR/done/$name"\n')
+        rsh.write('        else\n')
+        rsh.write('            mv "$TASKDIR/running/$name" "$TASKDIR/failed/$name"\n')
+        rsh.write('        fi\n')
+        rsh.write('        echo "Info: ${name#*_} finished from task queue"\n')
+        rsh.write('    done\n')
+        rsh.write('}\n')
+        if asyn > 0:
+            rsh.write('for i in $(seq 1 %i); do\n' % asyn)
+            rsh.write('    mjdir_worker &\n')
+            rsh.write('done\n')
+            rsh.write('wait\n')
+        else:
+            rsh.write('mjdir_worker\n')
+
+
+def _make_slurm_sub_cmd(dirmain, slurm_submit, bash_submit):
     sbatch_cmd = ['sbatch']
     for keys, values in bash_submit.items():
         sbatch_cmd = sbatch_cmd + [keys, values]
-    sbatch_cmd = sbatch_cmd + [os.path.join(dirmain, slurm_submit)]
-    proc = subprocess.run(sbatch_cmd, capture_output=True)
-    id_sub = proc.stdout.decode('utf8').strip().split(" ")[-1]
+    return sbatch_cmd + [os.path.join(dirmain, slurm_submit)]
+
+
+def make_slurm_sub(dirmain, slurm_submit, bash_submit={}):
+    """ make submission command for slurm via sbatch. Returns the job id or None if submission failed."""
+    id_sub, error = submit_slurm_script(dirmain, slurm_submit, bash_submit)
+    if error is not None:
+        print("Error: Submission of %s failed: %s" % (slurm_submit, error))
+    return id_sub
+
+
+def submit_slurm_script(dirmain, slurm_submit, bash_submit={}):
+    """Submit a script via sbatch and return job id and error message.
+
+    Args:
+        dirmain (str): Main directory of the script.
+        slurm_submit (str): Name of the bash script.
+        bash_submit (dict): Arguments for sbatch like {'-p': "partition"}. Default is {}.
+
+    Returns:
+        tuple: Job id or None, error message or None. See is_slurm_limit_error() for errors of QOS limits.
+    """
+    sbatch_cmd = _make_slurm_sub_cmd(dirmain, slurm_submit, bash_submit)
+    try:
+        proc = subprocess.run(sbatch_cmd, capture_output=True)
+    except OSError as e:
+        return None, str(e)
+    SLURM_QUEUE_CACHE.invalidate()
+    return _parse_slurm_sub(proc.returncode, proc.stdout.decode('utf8'), proc.stderr.decode('utf8'))
+
+
+def _parse_slurm_sub(returncode, stdout, stderr):
+    match = re.search(r"Submitted batch job (\S+)", stdout)
+    if returncode != 0 or match is None:
+        error = stderr.strip() or stdout.strip() or "sbatch exit code %i" % returncode
+        return None, error
+    return match.group(1), None
+
+
+def is_slurm_limit_error(error):
+    """Whether an error of sbatch is due to a limit like MaxSubmitJobs, so that submission can be retried later."""
+    return error is not None and any(x in error for x in SLURM_LIMIT_ERRORS)
+
+
+async def make_slurm_sub_async(dirmain, slurm_submit, bash_submit={}, retries=3, retry_delay=1.0):
+    """Submit a script via sbatch without blocking the event loop.
+
+    Submission is retried with exponential backoff if sbatch fails with a transient error of the controller,
+    see SLURM_TRANSIENT_ERRORS.
+
+    Args:
+        dirmain (str): Main directory of the script.
+        slurm_submit (str): Name of the bash script.
+        bash_submit (dict): Arguments for sbatch like {'-p': "partition"}. Default is {}.
+        retries (int): Maximum number of retries. Default is 3.
+        retry_delay (float): Delay before the first retry in seconds, doubled for each retry. Default is 1.
+
+    Returns:
+        str: Job id or None if submission failed.
+    """
+    id_sub, error = await submit_slurm_script_async(dirmain, slurm_submit, bash_submit, retries=retries,
+                                                    retry_delay=retry_delay)
+    if error is not None:
+        print("Error: Submission of %s failed: %s" % (slurm_submit, error))
     return id_sub
 
 
-def make_slurm_queue(dirmain, print_level=0):
-    """get queue list from slurm """
-    # Check slurm
+async def submit_slurm_script_async(dirmain, slurm_submit, bash_submit={}, retries=3, retry_delay=1.0):
+    """Submit a script via sbatch without blocking the event loop, see make_slurm_sub_async().
+
+    Returns:
+        tuple: Job id or None, error message or None.
+    """
+    sbatch_cmd = _make_slurm_sub_cmd(dirmain, slurm_submit, bash_submit)
+    for attempt in range(retries + 1):
+        returncode, stdout, stderr = await _run_async(sbatch_cmd)
+        SLURM_QUEUE_CACHE.invalidate()
+        id_sub, error = _parse_slurm_sub(returncode, stdout, stderr)
+        if error is None:
+            return id_sub, None
+        if attempt < retries and any(x in error for x in SLURM_TRANSIENT_ERRORS):
+            await asyncio.sleep(retry_delay * 2 ** attempt)
+            continue
+        return None, error
+
+
+def make_slurm_cancel(ids, batch_size=1000):
+    """Cancel slurm ids with few scancel calls.
+
+    Tasks of the same job array are combined to one id like 12345_[1-3,7] and passed to scancel in batches.
+
+    Args:
+        ids (list): Slurm ids, see clean_slurm_id().
+        batch_size (int): Maximum number of ids per scancel call. Default is 1000.
+
+    Returns:
+        list: Ids that were cancelled, i.e. for which scancel reported no error.
+    """
+    cancelled = []
+    for batch in batch_slurm_ids(ids, batch_size):
+        try:
+            proc = subprocess.run(['scancel'] + batch, capture_output=True)
+        except OSError:
+            print("Error: Can not run scancel.")
+            break
+        cancelled += _parse_slurm_cancel(batch, proc.returncode, proc.stderr.decode('utf-8'))
+    SLURM_QUEUE_CACHE.invalidate()
+    return cancelled
+
+
+async def make_slurm_cancel_async(ids):
+    """Cancel slurm ids via a single scancel call without blocking the event loop, see make_slurm_cancel().
+
+    Args:
+        ids (list): Slurm ids, see clean_slurm_id().
+
+    Returns:
+        list: Ids that were cancelled, i.e. for which scancel reported no error.
+    """
+    if len(ids) == 0:
+        return []
+    batch = _group_slurm_ids(ids)
+    returncode, _, stderr = await _run_async(['scancel'] + batch)
+    SLURM_QUEUE_CACHE.invalidate()
+    return _parse_slurm_cancel(batch, returncode, stderr)
+
+
+def _group_slurm_ids(ids):
+    """Clean slurm ids and combine tasks of the same job array, unless the whole array is given."""
+    whole = []
+    tasks = {}
+    for x in ids:
+        main_id, task_id = split_slurm_id(clean_slurm_id(x))
+        if task_id is None:
+            if main_id not in whole:
+                whole.append(main_id)
+        else:
+            tasks.setdefault(main_id, []).append(task_id.strip("[]"))
+    grouped = list(whole)
+    for main_id, task_list in tasks.items():
+        if main_id in whole:
+            continue
+        if len(task_list) == 1 and task_list[0].isdigit():
+            grouped.append("%s_%s" % (main_id, task_list[0]))
+        else:
+            grouped.append("%s_[%s]" % (main_id, ",".join(task_list)))
+    return grouped
+
+
+def batch_slurm_ids(ids, batch_size=1000):
+    """Group slurm ids per job array and split them into batches for scancel, see make_slurm_cancel()."""
+    grouped = _group_slurm_ids(ids)
+    return [grouped[i:i + batch_size] for i in range(0, len(grouped), max(batch_size, 1))]
+
+
+def _parse_slurm_cancel(batch, returncode, stderr):
+    """Return the ids of batch that scancel did not report an error for."""
+    if returncode == -1:
+        print("Error: Can not run scancel.")
+        return []
+    failed = set(re.findall(r"job id (\S+?):", stderr))
+    cancelled = [x for x in batch if x not in failed]
+    if returncode != 0 and len(failed) == 0:
+        print("Error: scancel failed:", stderr.strip())
+        return []
+    for x in sorted(failed):
+        print("Warning: Could not cancel", x)
+    return cancelled
+
+
+async def _run_async(cmd):
+    """Run a command via asyncio and return exit code, stdout and stderr as str."""
+    try:
+        proc = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE,
+                                                    stderr=asyncio.subprocess.PIPE)
+    except OSError as e:
+        return -1, "", str(e)
+    stdout, stderr = await proc.communicate()
+    return proc.returncode, stdout.decode('utf-8'), stderr.decode('utf-8')
+
+
+def read_slurm_telemetry(dirmain):
+    """Read all telemetry records of jobs from <script>.jsonl files in dirmain.
+
+    Args:
+        dirmain (str): Main directory of the scripts.
+
+    Returns:
+        list: List of dicts with job, script, job_id, array_task, node, start, end, exit and maxrss_kb.
+    """
+    records = []
+    if not os.path.exists(dirmain):
+        return records
+    for entry in os.scandir(dirmain):
+        if not entry.name.endswith(".jsonl") or not entry.is_file():
+            continue
+        with open(entry.path, "r") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    print("Warning: Can not read telemetry line in", entry.name)
+    return records
+
+
+def read_slurm_states(dirmain, offsets=None, states=None):
+    """Read the latest state of jobs from <script>.state files in dirmain.
+
+    For repeated reading, pass the same offsets and states dicts. Then only lines appended since the last call
+    are read and states is updated in place.
+
+    Args:
+        dirmain (str): Main directory of the scripts.
+        offsets (dict): File name to byte offset of already read lines. Updated in place. Default is None.
+        states (dict): States of a previous call that are updated. Default is None.
+
+    Returns:
+        dict: Job name to tuple of (state, exit code or None, time, script name).
+    """
+    states = {} if states is None else states
+    if not os.path.exists(dirmain):
+        return states
+    for entry in os.scandir(dirmain):
+        if not entry.name.endswith(".state") or not entry.is_file():
+            continue
+        script = os.path.splitext(entry.name)[0] + ".sh"
+        offset = 0
+        if offsets is not None:
+            offset = offsets.get(entry.name, 0)
+            if offset == entry.stat().st_size:
+                continue
+            if offset > entry.stat().st_size:
+                offset = 0
+        with open(entry.path, "rb") as f:
+            f.seek(offset)
+            data = f.read()
+        # Only complete lines, a job may be appending right now.
+        data = data[:data.rfind(b"\n") + 1]
+        if offsets is not None:
+            offsets[entry.name] = offset + len(data)
+        for line in data.decode("utf-8", errors="replace").splitlines():
+            line_list = line.split()
+            if len(line_list) != 4:
+                continue
+            job, state, exit_code, time_stamp = line_list
+            try:
+                # Decimal comma of older markers written with a locale like de_DE
+                time_stamp = float(time_stamp.replace(",", "."))
+                exit_code = int(exit_code) if exit_code != "-" else None
+            except ValueError:
+                print("Warning: Can not read state line in", entry.name)
+                continue
+            if job in states and states[job][2] > time_stamp:
+                continue
+            states[job] = (state, exit_code, time_stamp, script)
+    return states
+
+
+def split_slurm_id(job_id):
+    """Split a slurm job id into job id and array task part.
+
+    Args:
+        job_id (str,int): Slurm id like 12345, 12345_7 or 12345_[8-20%4].
+
+    Returns:
+        tuple: job id, array task (str) or None for no array task.
+    """
+    job_id = str(job_id).strip()
+    if "_" in job_id:
+        main_id, task_id = job_id.split("_", 1)
+        return main_id, task_id
+    return job_id, None
+
+
+def clean_slurm_id(job_id):
+    """Make a slurm id from squeue usable for scancel, e.g. strip the throttle of pending array ranges."""
+    main_id, task_id = split_slurm_id(job_id)
+    if task_id is None:
+        return main_id
+    task_id = task_id.split("%")[0]
+    if task_id.startswith("[") and not task_id.endswith("]"):
+        task_id += "]"
+    return main_id + "_" + task_id
+
+
+def query_slurm_queue(names=None, ids=None, user=None):
+    """Query squeue once with a compact, delimited output format.
+
+    Args:
+        names (list): Only query jobs with these job names via --name. Default is None.
+        ids (list): Only query these job ids via --jobs. Default is None.
+        user (str): Only query jobs of this user. Default is None, the current user if no ids are given, so that
+                    jobs of other users with the same names are not included.
+
+    Returns:
+        list: List of dicts with id, name, state and command, i.e. the path of the submitted script.
+              None if squeue failed, e.g. due to a timeout of the slurm controller.
+    """
+    try:
+        proc = subprocess.run(_make_slurm_queue_cmd(names, ids, user), capture_output=True)
+    except OSError:
+        print("Error: Can not run squeue.")
+        return None
+    if proc.returncode != 0:
+        print("Error: squeue failed:", proc.stderr.decode('utf-8').strip())
+        return None
+    return _parse_slurm_queue(proc.stdout.decode('utf-8'))
+
+
+async def query_slurm_queue_async(names=None, ids=None, user=None):
+    """Query squeue without blocking the event loop, see query_slurm_queue()."""
+    returncode, stdout, stderr = await _run_async(_make_slurm_queue_cmd(names, ids, user))
+    if returncode == -1:
+        print("Error: Can not run squeue.")
+        return None
+    if returncode != 0:
+        print("Error: squeue failed:", stderr.strip())
+        return None
+    return _parse_slurm_queue(stdout)
+
+
+def _make_slurm_queue_cmd(names=None, ids=None, user=None):
+    squeue_cmd = ['squeue', '--noheader', '--format=%i|%j|%T|%o']
+    if names is not None:
+        squeue_cmd.append('--name=' + ",".join(names))
+    if ids is not None:
+        squeue_cmd.append('--jobs=' + ",".join([str(x) for x in ids]))
+    if user is None and ids is None:
+        user = os.environ.get('USER')
+    if user is not None:
+        squeue_cmd += ['-u', user]
+    return squeue_cmd
+
+
+def _parse_slurm_queue(output):
+    entries = []
+    for line in output.split('\n'):
+        fields = line.strip().split("|", 3)
+        if len(fields) != 4:
+            continue
+        entries.append({'id': fields[0], 'name': fields[1], 'state': fields[2], 'command': fields[3]})
+    return entries
+
+
+class SlurmQueueCache(object):
+    """Process-wide cache of the squeue output that is shared by all job directories.
+
+    Directories register the names of their scripts. A single squeue call filtered by the names of all
+    registered directories then answers all directories until the entries are older than ttl seconds.
+    If squeue fails, the previous entries are kept and squeue is queried again on next access. Without previous
+    entries that cover the registered names a RuntimeError is raised, since an empty queue would mark all running
+    jobs as failed.
+    """
+
+    def __init__(self, ttl=10.0, max_names=500):
+        """Initialize empty cache.
+
+        Args:
+            ttl (float): Time in seconds after which the queue is queried again. Default is 10.
+            max_names (int): Maximum number of job names for --name filtering. If more names are registered,
+                             all jobs of the user are queried. Default is 500.
+        """
+        self.ttl = ttl
+        self.max_names = max_names
+        self.names = set()
+        self._queried_names = None
+        self._time = None
+        self._entries = []
+        self._is_valid = False
+        self._lock = None
+        self._lock_loop = None
+
+    def invalidate(self):
+        """Force a new squeue call on next access, e.g. after submission or cancellation."""
+        self._time = None
+
+    def entries(self, names=None, max_age=None):
+        """Get cached queue entries and query squeue if expired or names are not covered.
+
+        Args:
+            names (list): Job names to register. Default is None.
+            max_age (float): Maximum age of the cached entries in seconds. Default is None, use ttl.
+
+        Returns:
+            list: List of dicts with id, name, state and command, see query_slurm_queue().
+
+        Raises:
+            RuntimeError: If squeue failed and no previous entries cover the names.
+        """
+        query = self._get_query(names, max_age)
+        if query is not None:
+            self._set_entries(query_slurm_queue(**query), query)
+        return self._entries
+
+    async def entries_async(self, names=None, max_age=None):
+        """Get cached queue entries without blocking the event loop, see entries().
+
+        Concurrent calls wait for a single squeue call.
+        """
+        loop = asyncio.get_running_loop()
+        if self._lock is None or self._lock_loop is not loop:
+            self._lock = asyncio.Lock()
+            self._lock_loop = loop
+        if names is not None:
+            self.names.update(names)
+        async with self._lock:
+            query = self._get_query(None, max_age)
+            if query is not None:
+                self._set_entries(await query_slurm_queue_async(**query), query)
+        return self._entries
+
+    def _get_query(self, names, max_age):
+        """Register names and return arguments for query_slurm_queue() or None if the cache is valid."""
+        if names is not None:
+            self.names.update(names)
+        max_age = self.ttl if max_age is None else max_age
+        is_expired = self._time is None or time.monotonic() - self._time > max_age
+        is_covered = self._queried_names is None or self.names.issubset(self._queried_names)
+        if not is_expired and is_covered:
+            return None
+        if len(self.names) == 0:
+            return None
+        if len(self.names) > self.max_names:
+            return {}
+        return {'names': sorted(self.names)}
+
+    def _set_entries(self, entries, query):
+        if entries is None:
+            is_covered = self._queried_names is None or self.names.issubset(self._queried_names)
+            if not self._is_valid or not is_covered:
+                raise RuntimeError("Can not get the queue from squeue.")
+            print("Warning: Using previous queue information.")
+            return
+        self._queried_names = set(query['names']) if 'names' in query else None
+        self._entries = entries
+        self._is_valid = True
+        self._time = time.monotonic()
+
+
+SLURM_QUEUE_CACHE = SlurmQueueCache()
+
+
+def make_slurm_queue(dirmain, print_level=0, max_age=None):
+    """Get queue list from slurm via the shared SLURM_QUEUE_CACHE.
+
+    Jobs are matched to dirmain by the directory of their script, which is submitted with full path by
+    make_slurm_sub(), so that no file system access is needed per job.
+
+    Args:
+        dirmain (str): Main directory of the scripts.
+        print_level (int): Print information, 0 means no print. Default is 0.
+        max_age (float): Maximum age of cached queue information in seconds. Default is None, the ttl of the cache.
+
+    Returns:
+        tuple: List of ids, list of script names.
+    """
+    names = _get_script_names(dirmain)
+    if len(names) == 0:
+        return [], []
+    entries = SLURM_QUEUE_CACHE.entries(names=names, max_age=max_age)
+    return _match_slurm_queue(dirmain, entries, print_level)
+
+
+async def make_slurm_queue_async(dirmain, print_level=0, max_age=None):
+    """Get queue list from slurm without blocking the event loop, see make_slurm_queue()."""
+    names = _get_script_names(dirmain)
+    if len(names) == 0:
+        return [], []
+    entries = await SLURM_QUEUE_CACHE.entries_async(names=names, max_age=max_age)
+    return _match_slurm_queue(dirmain, entries, print_level)
+
+
+SLURM_SCRIPT_NAMES = {}
+
+
+def _get_script_names(dirmain):
+    """Names of the scripts in dirmain. The directory is only listed again if its modification time changed
+    or is too recent to rule out changes within the time resolution of the file system."""
+    mtime = os.stat(dirmain).st_mtime_ns
+    cached = SLURM_SCRIPT_NAMES.get(dirmain)
+    if cached is not None and cached[0] == mtime and time.time() - mtime / 1e9 > 2.0:
+        return cached[1]
+    with os.scandir(dirmain) as it:
+        names = [x.name for x in it if x.name.endswith(".sh")]
+    SLURM_SCRIPT_NAMES[dirmain] = (mtime, names)
+    return names
+
+
+def _match_slurm_queue(dirmain, entries, print_level=0):
+    """Select the queue entries of scripts in dirmain."""
     list_ids = []
     list_scripts = []
-    usr = os.environ.get('USER')
-    proc = subprocess.run(['squeue', "-u", usr, "-O", "jobid:.50,name:.150,stdout:.200"], capture_output=True)
-    all_info_user = proc.stdout.decode('utf-8').split('\n')
-    all_info_user = [x for x in all_info_user if x != '']
+    dir_paths = {os.path.abspath(dirmain), os.path.realpath(dirmain)}
+    real_paths = {}
     if print_level == 2:
-        print("Number of Slurm tasks running:", len(all_info_user) - 1)
-    for i in range(1, len(all_info_user)):
-        line_id = all_info_user[i][:50].strip()
-        line_bashname = all_info_user[i][50:200].strip()
-        line_jobdir = all_info_user[i][200:].strip()
-        line_jobdir = os.path.realpath(line_jobdir)
-        # Check bash name plus directory via slurm output (requires slurm submit as above)
-        if (os.path.exists(os.path.join(dirmain, line_bashname)) and os.path.basename(dirmain) == os.path.basename(
-                os.path.dirname(line_jobdir))):
-            list_ids.append(line_id)
-            list_scripts.append(line_bashname)
+        print("Number of Slurm tasks running:", len(entries))
+    for x in entries:
+        line_jobdir = os.path.dirname(x['command'])
+        if line_jobdir not in dir_paths:
+            if line_jobdir not in real_paths:
+                real_paths[line_jobdir] = os.path.realpath(line_jobdir)
+            line_jobdir = real_paths[line_jobdir]
+        if line_jobdir in dir_paths and os.path.basename(x['command']) == x['name']:
+            list_ids.append(x['id'])
+            list_scripts.append(x['name'])
             if print_level >= 3:
-                print("ID: ", line_id, ", Script: ", line_bashname)
+                print("ID: ", x['id'], ", Script: ", x['name'])
     if print_level == 2:
         print("Number of Slurms tasks running for this directory:", len(list_scripts))
     return list_ids, list_scripts
 
+
+def make_slurm_accounting(ids):
+    """Get state and exit code of finished or running jobs from sacct in a single call.
+
+    Args:
+        ids (list): Slurm job ids.
+
+    Returns:
+        dict: Job id to dict with name, state and exit_code. Array tasks have ids like 12345_7.
+    """
+    if len(ids) == 0:
+        return {}
+    sacct_cmd = ['sacct', '--noheader', '--parsable2', '--allocations', '--format=JobID,JobName,State,ExitCode',
+                 '--jobs=' + ",".join([clean_slurm_id(x) for x in ids])]
+    try:
+        proc = subprocess.run(sacct_cmd, capture_output=True)
+    except OSError:
+        print("Error: Can not run sacct.")
+        return {}
+    accounting = {}
+    for line in proc.stdout.decode('utf-8').split('\n'):
+        fields = line.strip().split("|")
+        if len(fields) != 4:
+            continue
+        exit_code = fields[3].split(":")[0]
+        accounting[fields[0]] = {'name': fields[1], 'state': fields[2].split(" ")[0],
+                                 'exit_code': int(exit_code) if exit_code.isdigit() else None}
+    return accounting
+
 # def _get_jobs_from_slurmlog(dirmain,logfile,full_path=False):
 #     """check a possible log file for individual commands"""
 #     scr_path = os.path.join(dirmain,logfile)
@@ -0,0 +1,292 @@
+import json
+import os
+import re
+import threading
+
+from mjdir.storage import file_lock
+
+
+class ResultsTable(object):
+    """Columnar table of job results with one memory-mapped .npy file per quantity.
+
+    Each job has one row. The row of a job is its job index, and the job names in order of the rows are kept in
+    jobs.jsonl. Every column has a validity mask <column>.mask.npy, which is False for rows without a value for
+    that column, e.g. failed jobs. Rows are appended as jobs finish and updated in place for jobs that are written
+    again. Columns are allocated with a capacity that is doubled when full, so that appending is amortized
+    constant time. The number of valid rows, the capacity and the columns are stored in table.json, which is
+    replaced atomically after the data was written, so that readers always see complete rows.
+
+    Reading a column is a read-only memory map of the .npy file without copying, which can also be opened by
+    np.load(filepath, mmap_mode='r')[:len(table)]. Appending is guarded by a file lock. Requires numpy.
+    """
+
+    def __init__(self, dirpath, initial_capacity=1024):
+        """Initialize table. The directory is created on first append.
+
+        Args:
+            dirpath (str): Directory of the table.
+            initial_capacity (int): Number of rows allocated for new columns. Default is 1024.
+        """
+        self.dirpath = dirpath
+        self.initial_capacity = initial_capacity
+        self.metapath = os.path.join(dirpath, "table.json")
+        self.namespath = os.path.join(dirpath, "jobs.jsonl")
+        self.lockpath = os.path.join(dirpath, "table.lock")
+        self._lock = threading.Lock()
+        self._names = []
+        self._rows = {}
+        self._names_offset = 0
+
+    def _read_meta(self):
+        if not os.path.exists(self.metapath):
+            return {"size": 0, "capacity": 0, "columns": {}}
+        with open(self.metapath, "r") as f:
+            return json.load(f)
+
+    def _write_meta(self, meta):
+        temppath = "%s.%i.tmp" % (self.metapath, os.getpid())
+        with open(temppath, "w") as f:
+            json.dump(meta, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temppath, self.metapath)
+
+    def _get_column_path(self, column, mask=False):
+        return os.path.join(self.dirpath, column + (".mask.npy" if mask else ".npy"))
+
+    def _read_names(self, size):
+        """Update the cached job names to the first size rows by reading only new lines of jobs.jsonl."""
+        if size < len(self._names):
+            self._names, self._rows, self._names_offset = [], {}, 0
+        if size == len(self._names):
+            return self._names
+        with open(self.namespath, "rb") as f:
+            f.seek(self._names_offset)
+            while len(self._names) < size:
+                line = f.readline()
+                if not line.endswith(b"\n"):
+                    raise ValueError("Table %s has fewer job names than rows." % self.dirpath)
+                name = json.loads(line.decode("utf-8"))
+                self._rows[name] = len(self._names)
+                self._names.append(name)
+                self._names_offset += len(line)
+        return self._names
+
+    def __len__(self):
+        return self._read_meta()["size"]
+
+    def names(self):
+        """
+        Job names in order of the rows.
+
+        Returns:
+            list: Job name of each row.
+        """
+        with self._lock:
+            return list(self._read_names(self._read_meta()["size"]))
+
+    def rows(self, jobs):
+        """
+        Job index of jobs, i.e. their row in the columns.
+
+        Args:
+            jobs (list): Job names.
+
+        Returns:
+            list: Row of each job, None for jobs not in the table.
+        """
+        with self._lock:
+            self._read_names(self._read_meta()["size"])
+            return [self._rows.get(x) for x in jobs]
+
+    def columns(self):
+        """
+        Columns of the table.
+
+        Returns:
+            dict: Column name to dict with 'dtype' and 'shape' of a single row.
+        """
+        return self._read_meta()["columns"]
+
+    def column(self, name):
+        """
+        Read-only memory map of a column without copying the data.
+
+        Args:
+            name (str): Column name.
+
+        Returns:
+            np.ndarray: Values of all rows. Rows with a False validity mask contain zeros.
+        """
+        import numpy as np
+        meta = self._read_meta()
+        if name not in meta["columns"]:
+            raise ValueError("Unknown column %s, available are %s" % (name, list(meta["columns"].keys())))
+        return np.load(self._get_column_path(name), mmap_mode="r")[:meta["size"]]
+
+    def mask(self, name):
+        """
+        Read-only memory map of the validity mask of a column.
+
+        Args:
+            name (str): Column name.
+
+        Returns:
+            np.ndarray: Boolean array, True for rows with a value.
+        """
+        import numpy as np
+        meta = self._read_meta()
+        if name not in meta["columns"]:
+            raise ValueError("Unknown column %s, available are %s" % (name, list(meta["columns"].keys())))
+        return np.load(self._get_column_path(name, mask=True), mmap_mode="r")[:meta["size"]]
+
+    def load(self, columns=None):
+        """
+        Memory maps of several columns and their validity masks.
+
+        Args:
+            columns (list): Column names. Default is None, all columns.
+
+        Returns:
+            values, masks (tuple): Dicts of column name to values and to validity mask.
+        """
+        if columns is None:
+            columns = list(self.columns().keys())
+        return {x: self.column(x) for x in columns}, {x: self.mask(x) for x in columns}
+
+    @staticmethod
+    def _get_column_dtype(value):
+        """Column type of a value: float64 for numbers, bool and complex128 are kept."""
+        import numpy as np
+        value = np.asarray(value)
+        if value.dtype.kind == "b":
+            return "|b1", value.shape
+        if value.dtype.kind == "c":
+            return "<c16", value.shape
+        if value.dtype.kind in "iuf":
+            return "<f8", value.shape
+        return None, value.shape
+
+    def _grow(self, meta, size):
+        """Double the capacity of all columns until size rows fit. Requires lock."""
+        capacity = max(meta["capacity"], self.initial_capacity)
+        while capacity < size:
+            capacity *= 2
+        if capacity == meta["capacity"]:
+            return
+        for name, info in meta["columns"].items():
+            for is_mask in [False, True]:
+                filepath = self._get_column_path(name, mask=is_mask)
+                self._resize_column(filepath, "|b1" if is_mask else info["dtype"],
+                                    [] if is_mask else info["shape"], meta["size"], capacity)
+        meta["capacity"] = capacity
+
+    @staticmethod
+    def _resize_column(filepath, dtype, shape, size, capacity):
+        """Write a column with new capacity, copy the first size rows and replace the old file. Requires lock."""
+        import numpy as np
+        temppath = "%s.%i.tmp" % (filepath, os.getpid())
+        new = np.lib.format.open_memmap(temppath, mode="w+", dtype=np.dtype(dtype), shape=(capacity,) + tuple(shape))
+        if size > 0 and os.path.exists(filepath):
+            new[:size] = np.load(filepath, mmap_mode="r")[:size]
+        new.flush()
+        del new
+        os.replace(temppath, filepath)
+
+    def append(self, results):
+        """
+        Write results of jobs to the table. New jobs are appended as rows, rows of existing jobs are updated.
+
+        New columns are created from the first value. Numbers are stored as float64, bools and complex numbers
+        are kept. Values can also be arrays of fixed shape per column. Columns without a value for a job, e.g.
+        None, are marked as invalid in the row of the job.
+
+        Args:
+            results (dict): Job name to dict of column name to value, e.g. the result of read_xtb_output().
+
+        Returns:
+            list: Rows of the jobs.
+        """
+        import numpy as np
+        if len(results) == 0:
+            return []
+        os.makedirs(self.dirpath, exist_ok=True)
+        with self._lock, file_lock(self.lockpath):
+            meta = self._read_meta()
+            size = meta["size"]
+            self._read_names(size)
+
+            # Rows of jobs
+            new_names = [x for x in results if x not in self._rows]
+            rows = {x: self._rows[x] for x in results if x in self._rows}
+            rows.update({x: size + i for i, x in enumerate(new_names)})
+            new_size = size + len(new_names)
+            self._grow(meta, new_size)
+
+            # New columns
+            for value in results.values():
+                for key, x in value.items():
+                    if key in meta["columns"] or x is None:
+                        continue
+                    if not re.match(r"^[A-Za-z0-9_]+$", key):
+                        raise ValueError("Invalid column name %s, use letters, digits and underscore." % key)
+                    dtype, shape = self._get_column_dtype(x)
+                    if dtype is None:
+                        raise ValueError("Column %s must be numeric or bool." % key)
+                    meta["columns"][key] = {"dtype": dtype, "shape": list(shape)}
+                    for is_mask in [False, True]:
+                        self._resize_column(self._get_column_path(key, mask=is_mask), "|b1" if is_mask else dtype,
+                                            [] if is_mask else shape, 0, meta["capacity"])
+
+            # Values
+            row_index = np.array([rows[x] for x in results], dtype=np.int64)
+            num_invalid = 0
+            for key, info in meta["columns"].items():
+                dtype = np.dtype(info["dtype"])
+                values = np.zeros((len(results),) + tuple(info["shape"]), dtype=dtype)
+                valid = np.zeros(len(results), dtype=bool)
+                for i, x in enumerate(results.values()):
+                    if x.get(key) is None:
+                        continue
+                    try:
+                        value = np.asarray(x[key], dtype=dtype)
+                        if value.shape != values.shape[1:]:
+                            raise ValueError("Shape %s does not match %s." % (value.shape, values.shape[1:]))
+                        values[i] = value
+                        valid[i] = True
+                    except (ValueError, TypeError):
+                        num_invalid += 1
+                column = np.load(self._get_column_path(key), mmap_mode="r+")
+                column[row_index] = values
+                column.flush()
+                mask = np.load(self._get_column_path(key, mask=True), mmap_mode="r+")
+                mask[row_index] = valid
+                mask.flush()
+                del column, mask
+            if num_invalid > 0:
+                print("Warning: Could not convert %i values to the type of their column." % num_invalid)
+
+            # Job names and size
+            with open(self.namespath, "ab") as f:
+                f.truncate(self._names_offset)
+                f.write("".join(json.dumps(x) + "\n" for x in new_names).encode("utf-8"))
+            meta["size"] = new_size
+            self._write_meta(meta)
+        return [int(x) for x in row_index]
+
+    def clear(self):
+        """Remove all rows and columns of the table."""
+        with self._lock:
+            if not os.path.exists(self.dirpath):
+                return
+            with file_lock(self.lockpath):
+                meta = self._read_meta()
+                self._write_meta({"size": 0, "capacity": 0, "columns": {}})
+                for name in meta["columns"]:
+                    for is_mask in [False, True]:
+                        filepath = self._get_column_path(name, mask=is_mask)
+                        if os.path.exists(filepath):
+                            os.remove(filepath)
+                if os.path.exists(self.namespath):
+                    os.remove(self.namespath)
+            self._names, self._rows, self._names_offset = [], {}, 0
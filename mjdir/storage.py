@@ -0,0 +1,478 @@
+import asyncio
+import contextlib
+import errno
+import json
+import os
+import sqlite3
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
+
+@contextlib.contextmanager
+def file_lock(filepath, shared=False):
+    """Context manager for an inter-process lock via fcntl on filepath.
+
+    Locks work across nodes only if the filesystem supports POSIX locks, e.g. lustre mounted with flock.
+    Without fcntl (e.g. on Windows) no lock is acquired.
+
+    Args:
+        filepath (str): Path of the lock file. Created if it does not exist.
+        shared (bool): Whether to acquire a shared (read) lock instead of an exclusive lock. Default is False.
+    """
+    if fcntl is None:
+        yield
+        return
+    with open(filepath, 'a+') as lock_file:
+        fcntl.lockf(lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.lockf(lock_file, fcntl.LOCK_UN)
+
+
+@contextlib.asynccontextmanager
+async def async_file_lock(filepath, shared=False, poll_interval=0.05):
+    """Async context manager for the lock of file_lock() that does not block the event loop while waiting.
+
+    The lock is polled without blocking until it is free. Like file_lock(), it does not exclude coroutines of the
+    same process, which need an additional asyncio.Lock.
+
+    Args:
+        filepath (str): Path of the lock file. Created if it does not exist.
+        shared (bool): Whether to acquire a shared (read) lock instead of an exclusive lock. Default is False.
+        poll_interval (float): Time in seconds between attempts to acquire the lock. Default is 0.05.
+    """
+    if fcntl is None:
+        yield
+        return
+    with open(filepath, 'a+') as lock_file:
+        while True:
+            try:
+                fcntl.lockf(lock_file, (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | fcntl.LOCK_NB)
+                break
+            except OSError as e:
+                if e.errno not in (errno.EACCES, errno.EAGAIN):
+                    raise
+            await asyncio.sleep(poll_interval)
+        try:
+            yield
+        finally:
+            fcntl.lockf(lock_file, fcntl.LOCK_UN)
+
+
+class JsonStorage(object):
+    """Storage backend to keep jobinfo in a single json file in the main directory.
+
+    Multiple processes can use the same directory: Access is guarded by a file lock, saves are written atomically
+    via rename and changes of other processes since load() are merged on save(). Single jobs can be saved via a
+    journal file without rewriting the json file.
+    """
+
+    lazy = False
+
+    def __init__(self, dirmain, filename="JOBDIR_Info.json"):
+        """Initialize json storage.
+
+        Args:
+            dirmain (str): Main job directory.
+            filename (str): Filename of the json file in the main directory.
+        """
+        self.filepath = os.path.join(dirmain, filename)
+        self.journalpath = self.filepath + ".journal"
+        self.lockpath = self.filepath + ".lock"
+        self._snapshot = {}
+        self._file_state = None
+
+    def exists(self):
+        return os.path.exists(self.filepath) or os.path.exists(self.journalpath)
+
+    @staticmethod
+    def _dumps(value):
+        return json.dumps(value, default=dict, sort_keys=True)
+
+    @staticmethod
+    def _fingerprint(value):
+        """Hash of the json representation of a job to detect changes without keeping a copy."""
+        return hash(JsonStorage._dumps(value))
+
+    def _get_file_state(self):
+        """Size, modification time and inode of json file and journal to detect writes of other processes."""
+        state = []
+        for filepath in [self.filepath, self.journalpath]:
+            try:
+                stat = os.stat(filepath)
+                state.append((stat.st_size, stat.st_mtime_ns, stat.st_ino))
+            except OSError:
+                state.append(None)
+        return state
+
+    @staticmethod
+    def _iter_json_items(json_file, chunk_size=1048576):
+        """Yield key and value of the top level json object of a file one at a time, so that neither the whole
+        file nor a dict of all values is kept in memory."""
+        decoder = json.JSONDecoder()
+        buffer, pos, eof = "", 0, False
+        state = "start"
+        key = None
+        while True:
+            while pos < len(buffer) and buffer[pos].isspace():
+                pos += 1
+            need_data = pos == len(buffer)
+            if not need_data and state in ("key", "key_or_end", "value"):
+                if state == "key_or_end" and buffer[pos] == "}":
+                    return
+                try:
+                    token, end = decoder.raw_decode(buffer, pos)
+                    # A number at the end of the buffer may continue in the next chunk, e.g. '16158' of '16158.5'
+                    need_data = not eof and (end == len(buffer) or buffer[end] in "0123456789.eE+-")
+                except ValueError:
+                    if eof:
+                        raise
+                    need_data = True
+            if need_data:
+                if eof:
+                    raise ValueError("Unexpected end of json file %s." % json_file.name)
+                chunk = json_file.read(chunk_size)
+                eof = chunk == ""
+                buffer, pos = buffer[pos:] + chunk, 0
+                continue
+            if state == "start" and buffer[pos] == "{":
+                pos += 1
+                state = "key_or_end"
+            elif state in ("key", "key_or_end") and isinstance(token, str):
+                key, pos = token, end
+                state = "colon"
+            elif state == "colon" and buffer[pos] == ":":
+                pos += 1
+                state = "value"
+            elif state == "value":
+                pos = end
+                state = "separator"
+                yield key, token
+            elif state == "separator" and buffer[pos] in ",}":
+                if buffer[pos] == "}":
+                    return
+                pos += 1
+                state = "key"
+            else:
+                raise ValueError("Invalid json object in %s at '%s'." % (json_file.name, buffer[pos:pos + 20]))
+
+    def _iter_entries(self):
+        """Yield job name and information of the json file and then of the journal, where None is a deleted job.
+        Requires lock."""
+        if os.path.exists(self.filepath):
+            with open(self.filepath) as json_file:
+                for entry in self._iter_json_items(json_file):
+                    yield entry
+        if os.path.exists(self.journalpath):
+            with open(self.journalpath) as journal_file:
+                for line in journal_file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        print("Warning: Skipping incomplete line in", self.journalpath)
+                        continue
+                    yield entry['job'], entry['info']
+
+    def _read(self, jobinfo=None, snapshot=None):
+        """Read json file and replay journal into jobinfo one job at a time. Requires lock.
+
+        Args:
+            jobinfo (MutableMapping): Mapping to fill. Default is None, a new dict.
+            snapshot (dict): Fingerprints of the read jobs are stored in snapshot. Default is None.
+        """
+        jobinfo = {} if jobinfo is None else jobinfo
+        for key, value in self._iter_entries():
+            if value is None:
+                jobinfo.pop(key, None)
+                if snapshot is not None:
+                    snapshot.pop(key, None)
+            else:
+                jobinfo[key] = value
+                if snapshot is not None:
+                    snapshot[key] = self._fingerprint(value)
+        return jobinfo
+
+    def load(self, jobinfo=None):
+        """Read jobinfo from json file. Returns an empty dict if no file exists.
+
+        Args:
+            jobinfo (MutableMapping): Empty mapping to fill, e.g. a JobTable, so that no dict of all jobs is built.
+                                      Default is None, a new dict.
+        """
+        self._snapshot = {}
+        with file_lock(self.lockpath, shared=True):
+            jobinfo = self._read(jobinfo, self._snapshot)
+            self._file_state = self._get_file_state()
+        return jobinfo
+
+    def _merge(self, jobinfo):
+        """Update jobinfo in place with the changes of other processes since load(), i.e. jobs that were added,
+        modified or deleted in the file but not in jobinfo. Requires lock."""
+        changed = set(key for key, value in jobinfo.items() if self._snapshot.get(key) != self._fingerprint(value))
+        changed.update(key for key in self._snapshot if key not in jobinfo)
+        on_disk = set()
+        updated = set()
+        for key, value in self._iter_entries():
+            if key in changed:
+                continue
+            if value is None:
+                jobinfo.pop(key, None)
+                on_disk.discard(key)
+                continue
+            on_disk.add(key)
+            # Later journal entries of a job replace earlier ones
+            if key not in jobinfo or key in updated or self._snapshot.get(key) != self._fingerprint(value):
+                jobinfo[key] = value
+                updated.add(key)
+        for key in [x for x in jobinfo if x not in on_disk and x not in changed]:
+            del jobinfo[key]
+
+    def _write(self, jobinfo):
+        """Atomically write jobinfo to the json file one job at a time and update the snapshot. Requires lock."""
+        temppath = "%s.%i.tmp" % (self.filepath, os.getpid())
+        self._snapshot = {}
+        with open(temppath, 'w') as json_file:
+            json_file.write("{")
+            for i, (key, value) in enumerate(jobinfo.items()):
+                data = self._dumps(value)
+                self._snapshot[key] = hash(data)
+                json_file.write("%s%s: %s" % (", " if i > 0 else "", json.dumps(key), data))
+            json_file.write("}")
+            json_file.flush()
+            os.fsync(json_file.fileno())
+        os.replace(temppath, self.filepath)
+
+    def save(self, jobinfo, jobs=None):
+        """Save jobinfo and merge changes of other processes since load().
+
+        Args:
+            jobinfo (MutableMapping): Job information, which is updated in place with the changes of other
+                                      processes, e.g. a dict or a JobTable.
+            jobs (list): Only append these jobs to the journal instead of rewriting the json file. Default is None.
+
+        Returns:
+            MutableMapping: Merged jobinfo of all processes, or None if only jobs are saved.
+        """
+        if jobs is not None:
+            with file_lock(self.lockpath):
+                # Own journal entries are not changes of other processes
+                is_unchanged = self._file_state == self._get_file_state()
+                with open(self.journalpath, 'a') as journal_file:
+                    for x in jobs:
+                        info = jobinfo[x] if x in jobinfo else None
+                        journal_file.write(json.dumps({'job': x, 'info': info}, default=dict) + "\n")
+                        if info is None:
+                            self._snapshot.pop(x, None)
+                        else:
+                            self._snapshot[x] = self._fingerprint(info)
+                if is_unchanged:
+                    self._file_state = self._get_file_state()
+            return None
+        with file_lock(self.lockpath):
+            if self._file_state != self._get_file_state():
+                self._merge(jobinfo)
+            self._write(jobinfo)
+            if os.path.exists(self.journalpath):
+                os.remove(self.journalpath)
+            self._file_state = self._get_file_state()
+        return jobinfo
+
+    def close(self):
+        pass
+
+
+class SqliteJobInfo(MutableMapping):
+    """Dict-like jobinfo that reads jobs on demand from a sqlite database.
+
+    Jobs are cached once accessed. Changes are kept in memory and only changed entries are written by save().
+    """
+
+    def __init__(self, connection):
+        self._conn = connection
+        self._cache = {}
+        self._snapshot = {}
+        self._deleted = set()
+
+    def _fetch(self, name):
+        row = self._conn.execute("SELECT data FROM jobs WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            return None
+        self._snapshot[name] = row[0]
+        self._cache[name] = json.loads(row[0])
+        return self._cache[name]
+
+    def __getitem__(self, name):
+        if name in self._deleted:
+            raise KeyError(name)
+        if name in self._cache:
+            return self._cache[name]
+        value = self._fetch(name)
+        if value is None:
+            raise KeyError(name)
+        return value
+
+    def __setitem__(self, name, value):
+        self._deleted.discard(name)
+        self._cache[name] = value
+
+    def __delitem__(self, name):
+        if name not in self:
+            raise KeyError(name)
+        self._cache.pop(name, None)
+        self._deleted.add(name)
+
+    def __contains__(self, name):
+        if name in self._deleted:
+            return False
+        if name in self._cache:
+            return True
+        return self._conn.execute("SELECT 1 FROM jobs WHERE name = ?", (name,)).fetchone() is not None
+
+    def __iter__(self):
+        in_db = set()
+        for (name,) in self._conn.execute("SELECT name FROM jobs ORDER BY rowid"):
+            in_db.add(name)
+            if name not in self._deleted:
+                yield name
+        for name in list(self._cache.keys()):
+            if name not in in_db:
+                yield name
+
+    def __len__(self):
+        if len(self._deleted) == 0 and all(x in self._snapshot for x in self._cache):
+            return self._conn.execute("SELECT count(*) FROM jobs").fetchone()[0]
+        return sum(1 for _ in self)
+
+    def select(self, state=None, tag=None):
+        """Get job names by indexed 'state' and 'tag' entries without loading the jobs.
+
+        Jobs that were accessed or changed since loading may differ from the database and are filtered in
+        memory instead, so that unsaved changes are considered.
+
+        Args:
+            state (str): State of the jobs. Default is None, any state.
+            tag (str): Tag of the jobs. Default is None, any tag.
+
+        Returns:
+            list: Job names in order of creation, followed by matching jobs accessed or changed since loading.
+        """
+        query = "SELECT name FROM jobs"
+        conditions = []
+        args = []
+        if state is not None:
+            conditions.append("state = ?")
+            args.append(state)
+        if tag is not None:
+            conditions.append("tag = ?")
+            args.append(tag)
+        if len(conditions) > 0:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY rowid"
+        selected = [x[0] for x in self._conn.execute(query, args) if x[0] not in self._deleted]
+        if len(self._cache) == 0:
+            return selected
+        selected = [x for x in selected if x not in self._cache]
+        return selected + [x for x, value in self._cache.items() if self._matches(value, state, tag)]
+
+    @staticmethod
+    def _matches(value, state, tag):
+        return (state is None or value.get('state') == state) and (tag is None or value.get('tag') == tag)
+
+    def flush(self, names=None):
+        """Write changed and deleted jobs to the database and commit.
+
+        Args:
+            names (list): Only write these jobs. Default is None, all changed jobs.
+        """
+        deleted = self._deleted if names is None else self._deleted.intersection(names)
+        cached = self._cache if names is None else {x: self._cache[x] for x in names if x in self._cache}
+        with self._conn:
+            if len(deleted) > 0:
+                self._conn.executemany("DELETE FROM jobs WHERE name = ?", [(x,) for x in deleted])
+            for name, value in cached.items():
+                data = json.dumps(value)
+                if self._snapshot.get(name) == data:
+                    continue
+                row = (data, value.get('state'), value.get('tag'), name)
+                cursor = self._conn.execute("UPDATE jobs SET data = ?, state = ?, tag = ? WHERE name = ?", row)
+                if cursor.rowcount == 0:
+                    self._conn.execute("INSERT INTO jobs (data, state, tag, name) VALUES (?, ?, ?, ?)", row)
+                self._snapshot[name] = data
+        self._deleted = self._deleted.difference(deleted)
+
+
+class SqliteStorage(object):
+    """Storage backend to keep jobinfo in a sqlite database in the main directory.
+
+    One row per job with indexed name, state and tag columns. The database uses WAL mode, which requires that all
+    processes accessing the database are on the same host, i.e. not on different nodes of a network filesystem.
+    Concurrent processes only write their changed rows, so that changes of different jobs are merged.
+    """
+
+    lazy = True
+
+    def __init__(self, dirmain, filename="JOBDIR_Info.sqlite"):
+        """Initialize sqlite storage.
+
+        Args:
+            dirmain (str): Main job directory.
+            filename (str): Filename of the database in the main directory.
+        """
+        self.filepath = os.path.join(dirmain, filename)
+        self._conn = None
+
+    def exists(self):
+        return os.path.exists(self.filepath)
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.filepath, timeout=60)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            with self._conn:
+                self._conn.execute("CREATE TABLE IF NOT EXISTS jobs (name TEXT PRIMARY KEY, state TEXT, tag TEXT, "
+                                   "data TEXT)")
+                self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state)")
+                self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_tag ON jobs (tag)")
+        return self._conn
+
+    def load(self):
+        """Open the database and return a lazy dict-like jobinfo."""
+        return SqliteJobInfo(self._connect())
+
+    def save(self, jobinfo, jobs=None):
+        """Write changed entries of jobinfo to the database.
+
+        Args:
+            jobinfo (dict): Job information.
+            jobs (list): Only write these jobs. Default is None.
+
+        Returns:
+            None
+        """
+        if isinstance(jobinfo, SqliteJobInfo):
+            jobinfo.flush(jobs)
+            return None
+        table = SqliteJobInfo(self._connect())
+        for key, value in jobinfo.items():
+            if jobs is None or key in jobs:
+                table[key] = value
+        table.flush()
+        return None
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+STORAGE_BACKENDS = {"json": JsonStorage, "sqlite": SqliteStorage}
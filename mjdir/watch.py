@@ -0,0 +1,87 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import time
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+
+
+class DirectoryWatcher(object):
+    """Wait for changes of files in a directory via inotify (Linux only).
+
+    Without inotify, wait() simply sleeps for the timeout. Note that on network filesystems like NFS or lustre
+    changes made on other nodes are not reported, so that callers should always re-check after wait() returns.
+    """
+
+    def __init__(self, dirpath):
+        """Start watching a directory.
+
+        Args:
+            dirpath (str): Directory to watch.
+        """
+        self.dirpath = dirpath
+        self._fd = None
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd < 0:
+                return
+            mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+            if libc.inotify_add_watch(fd, os.fsencode(dirpath), mask) < 0:
+                os.close(fd)
+                return
+            self._fd = fd
+        except (OSError, AttributeError, TypeError):
+            self._fd = None
+
+    @property
+    def is_active(self):
+        """Whether changes are reported via inotify."""
+        return self._fd is not None
+
+    def wait(self, timeout):
+        """Block until a file in the directory changes or timeout seconds passed.
+
+        Args:
+            timeout (float): Maximum time to wait in seconds.
+
+        Returns:
+            bool: Whether a change was reported.
+        """
+        if self._fd is None:
+            time.sleep(timeout)
+            return False
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if len(readable) == 0:
+            return False
+        self.drain()
+        return True
+
+    def fileno(self):
+        """File descriptor of inotify to wait on, e.g. via an event loop, or None if not active."""
+        return self._fd
+
+    def drain(self):
+        """Discard all pending events, only the wake up is of interest."""
+        if self._fd is None:
+            return
+        try:
+            while os.read(self._fd, 65536):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()